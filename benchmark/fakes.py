@@ -0,0 +1,347 @@
+import hashlib
+import json
+import math
+import re
+import threading
+import time
+from abc import ABCMeta, abstractmethod
+from collections import Counter
+from datetime import date
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingTCPServer, StreamRequestHandler
+from typing import Final, Dict, List, Tuple, Callable, Optional, Set
+from urllib.parse import urlsplit, parse_qs
+
+PROPERTY_ID: Final[str] = "bench-property"
+ORGANIZATION_ID: Final[int] = 1
+LATE_FEE_CATEGORY_ID: Final[int] = 99
+
+
+class FakeServerConfig:
+    def __init__(self, units: int, latency: float = 0.0, job_delay: float = 0.0, max_rate: float = 0.0) -> None:
+        self.units = units
+        self.latency = latency
+        self.job_delay = job_delay
+        # Requests per second each server answers before responding 429; 0 never throttles
+        self.max_rate = max_rate
+
+
+def unit_name(index: int) -> str:
+    return str(1000 + index)
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def __dispatch(self, method: str) -> None:
+        url = urlsplit(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+
+        server: FakeServer = self.server
+        time.sleep(server.config.latency)
+        for (route_method, pattern), route in server.routes.items():
+            match = re.fullmatch(pattern, url.path)
+            if route_method == method and match:
+                status = server.throttle() or server.reject(method, pattern, self.headers)
+                if status:
+                    payload, content_type = b"{}", "application/json"
+                else:
+                    status, payload, content_type = route(server, query, body, *match.groups())
+                break
+        else:
+            pattern = url.path
+            status, payload, content_type = 404, b"{}", "application/json"
+
+        # Answer conditional GETs like a server that supports ETags
+        etag = f'"{hashlib.sha1(payload).hexdigest()}"' if method == "GET" and status == 200 else None
+        if etag is not None and self.headers.get("If-None-Match") == etag:
+            status, payload = 304, b""
+
+        with server.lock:
+            server.requests[f"{method} {pattern}"] += 1
+            if status == 304:
+                server.not_modified += 1
+
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        if etag is not None:
+            self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(payload)))
+        self.send_header("Set-Cookie", "XSRF-TOKEN=bench-xsrf; Path=/")
+        if status == 429:
+            self.send_header("Retry-After", "1")
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self) -> None:
+        self.__dispatch("GET")
+
+    def do_POST(self) -> None:
+        self.__dispatch("POST")
+
+
+class FakeServer(ThreadingHTTPServer, metaclass=ABCMeta):
+    daemon_threads = True
+    routes: Dict[Tuple[str, str], Callable] = {}
+    # Routes that do not need a login token
+    public_routes: Tuple[str, ...] = (r"/login",)
+
+    def __init__(self, config: FakeServerConfig) -> None:
+        super().__init__(("127.0.0.1", 0), FakeHandler)
+        self.config = config
+        self.lock = threading.Lock()
+        self.requests: Counter = Counter()
+        self.tokens: Set[str] = set()
+        self.revoked = 0
+        self.window = (0, 0)
+        self.throttled = 0
+        self.not_modified = 0
+
+    def issue_token(self) -> str:
+        with self.lock:
+            token = f"bench-token-{len(self.tokens) + self.revoked}"
+            self.tokens.add(token)
+        return token
+
+    def revoke_tokens(self) -> None:
+        with self.lock:
+            self.revoked += len(self.tokens)
+            self.tokens.clear()
+
+    @abstractmethod
+    def token_of(self, headers) -> Optional[str]:
+        pass
+
+    def throttle(self) -> Optional[int]:
+        # Counts requests in one-second windows and turns away everything past max_rate in a window
+        if not self.config.max_rate:
+            return None
+        with self.lock:
+            second = int(time.monotonic())
+            count = self.window[1] + 1 if self.window[0] == second else 1
+            self.window = (second, count)
+            if count <= self.config.max_rate:
+                return None
+            self.throttled += 1
+            return 429
+
+    def reject(self, method: str, pattern: str, headers) -> Optional[int]:
+        if pattern in self.public_routes:
+            return None
+        with self.lock:
+            return None if self.token_of(headers) in self.tokens else 401
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"requests": sum(self.requests.values()), "byEndpoint": dict(self.requests),
+                    "throttled": self.throttled, "notModified": self.not_modified}
+
+
+def _json(payload) -> Tuple[int, bytes, str]:
+    return 200, json.dumps(payload, separators=(",", ":")).encode("utf-8"), "application/json"
+
+
+class FakeNextCentury(FakeServer):
+    def __init__(self, config: FakeServerConfig) -> None:
+        super().__init__(config)
+        self.jobs: Dict[str, float] = {}
+
+    # Read downloads are pre-signed, so they carry no token
+    public_routes = (r"/login", r"/reports/([^/]+)/([0-9-]+)_([0-9-]+)\.ndjson")
+
+    def token_of(self, headers) -> Optional[str]:
+        return headers.get("authorization")
+
+    def login(self, query, body):
+        return _json({"token": self.issue_token()})
+
+    def properties(self, query, body):
+        return _json([{"_id": PROPERTY_ID}])
+
+    def prepare(self, query, body, property_id):
+        start = query["start"]
+        end = query.get("end", start)
+        with self.lock:
+            ready_at = self.jobs.setdefault(f"{start}_{end}", time.monotonic() + self.config.job_delay)
+        if time.monotonic() < ready_at:
+            return _json({"state": "PENDING"})
+        return _json({"state": "COMPLETE", "url": f"{self.url}/reports/{property_id}/{start}_{end}.ndjson"})
+
+    def report(self, query, body, property_id, start, end):
+        lines = []
+        for day in range(date.fromisoformat(start).toordinal(), date.fromisoformat(end).toordinal() + 1):
+            read_date = date.fromordinal(day).isoformat()
+            for i in range(self.config.units):
+                lines.append(json.dumps({"unitId": f"u{i}", "meterRead": {
+                    "utilityTypeId": 5, "computed": day * (i % 7 + 1) * 10, "readDate": read_date}}))
+                lines.append(json.dumps({"unitId": f"u{i}", "meterRead": {
+                    "utilityTypeId": 1, "computed": day, "readDate": read_date}}))
+        return 200, ("\n".join(lines) + "\n").encode("utf-8"), "application/x-ndjson"
+
+    def units(self, query, body, property_id):
+        return _json([{"_id": f"u{i}", "name": unit_name(i)} for i in range(self.config.units)])
+
+    routes = {
+        ("POST", r"/login"): login,
+        ("GET", r"/api/Properties"): properties,
+        ("GET", r"/api/Properties/([^/]+)/PrepareReadDownload"): prepare,
+        ("GET", r"/reports/([^/]+)/([0-9-]+)_([0-9-]+)\.ndjson"): report,
+        ("GET", r"/api/Properties/([^/]+)/Units"): units,
+    }
+
+
+class FakePayHOA(FakeServer):
+    def __init__(self, config: FakeServerConfig) -> None:
+        super().__init__(config)
+        self.charges: List[dict] = []
+
+    public_routes = (r"/login", r"/sanctum/csrf-cookie")
+
+    def token_of(self, headers) -> Optional[str]:
+        return (headers.get("Authorization") or "").removeprefix("Bearer ")
+
+    def reject(self, method: str, pattern: str, headers) -> Optional[int]:
+        if method == "POST" and headers.get("X-XSRF-TOKEN") != "bench-xsrf":
+            return 419
+        return super().reject(method, pattern, headers)
+
+    def csrf_cookie(self, query, body):
+        return 204, b"", "text/plain"
+
+    def login(self, query, body):
+        return _json({"token": self.issue_token()})
+
+    def units(self, query, body, organization_id):
+        page, per_page = int(query.get("page", 1)), int(query.get("perPage", 200))
+        start = (page - 1) * per_page
+        return _json({
+            "data": [{"id": i, "address": {"line1": f"{unit_name(i)} Bench St"}}
+                     for i in range(start, min(start + per_page, self.config.units))],
+            "current_page": page,
+            "last_page": max(1, math.ceil(self.config.units / per_page)),
+            "total": self.config.units,
+        })
+
+    def create_charges(self, query, body):
+        with self.lock:
+            self.charges.extend({key: charge[key] for key in ("payorId", "chargeAmount", "activeAfter")}
+                                for charge in body["charges"])
+        return _json({"queued": True})
+
+    def list_charges(self, query, body, organization_id):
+        page, per_page = int(query.get("page", 1)), int(query.get("perPage", 200))
+        with self.lock:
+            charges = [charge for charge in self.charges
+                       if query["activeAfterStart"] <= charge["activeAfter"][:10] <= query["activeAfterEnd"]]
+        start = (page - 1) * per_page
+        return _json({
+            "data": charges[start:start + per_page],
+            "current_page": page,
+            "last_page": max(1, math.ceil(len(charges) / per_page)),
+            "total": len(charges),
+        })
+
+    def categories(self, query, body, organization_id):
+        return _json([{"id": 1, "name": "Income", "type": "income", "children": [
+            {"id": LATE_FEE_CATEGORY_ID, "name": "Late Fees", "type": "income"}
+        ]}])
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        with self.lock:
+            stats["charges"] = len(self.charges)
+        return stats
+
+    routes = {
+        ("GET", r"/sanctum/csrf-cookie"): csrf_cookie,
+        ("POST", r"/login"): login,
+        ("GET", r"/organizations/([0-9]+)/units"): units,
+        ("POST", r"/charges"): create_charges,
+        ("GET", r"/organizations/([0-9]+)/charges"): list_charges,
+        ("GET", r"/accounting/v2/organizations/([0-9]+)/categories"): categories,
+    }
+
+
+class FakeSmtpHandler(StreamRequestHandler):
+    # Just enough plain SMTP for smtplib: no TLS and no login, like a local relay
+    def handle(self) -> None:
+        server: FakeSmtp = self.server
+        with server.lock:
+            server.connections += 1
+        self.__reply("220 fake-smtp ready")
+        in_data = False
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            if in_data:
+                if line.rstrip(b"\r\n") == b".":
+                    in_data = False
+                    with server.lock:
+                        server.messages += 1
+                        # Hang up after every drop_after messages so clients have to reconnect
+                        drop = server.drop_after and server.messages % server.drop_after == 0
+                    self.__reply("250 OK queued")
+                    if drop:
+                        return
+                continue
+
+            command = line.decode("ascii", "replace").strip().split(" ")[0].upper()
+            time.sleep(server.latency)
+            if command == "EHLO":
+                self.__reply("250-fake-smtp", "250 8BITMIME")
+            elif command == "DATA":
+                in_data = True
+                self.__reply("354 End data with <CR><LF>.<CR><LF>")
+            elif command == "QUIT":
+                self.__reply("221 Bye")
+                return
+            elif command in ("HELO", "MAIL", "RCPT", "RSET", "NOOP"):
+                self.__reply("250 OK")
+            else:
+                self.__reply("502 Command not implemented")
+
+    def __reply(self, *lines: str) -> None:
+        self.wfile.write("".join(f"{line}\r\n" for line in lines).encode("ascii"))
+
+
+class FakeSmtp(ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latency: float = 0.0, drop_after: int = 0) -> None:
+        super().__init__(("127.0.0.1", 0), FakeSmtpHandler)
+        self.latency = latency
+        self.drop_after = drop_after
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.messages = 0
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"connections": self.connections, "messages": self.messages}
+
+
+def serve(config: FakeServerConfig, ready, stop) -> None:
+    # Runs both fakes in a separate process so their memory does not count against the client
+    servers = [FakeNextCentury(config), FakePayHOA(config)]
+    for server in servers:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    ready.put([server.url for server in servers])
+    stop.wait()
+    ready.put([server.stats() for server in servers])
+    for server in servers:
+        server.shutdown()
@@ -0,0 +1,65 @@
+import argparse
+import math
+import os
+import re
+import subprocess
+import sys
+from typing import Final, Dict, List, Optional, Tuple, Set
+
+ROOT: Final[str] = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Commands that must start quickly, the total import budget for our own modules in milliseconds,
+# and third party modules they must not load. Budgets leave room for a busy machine; the forbidden
+# modules are what catch a heavy import creeping in.
+BUDGETS: Final[List[Tuple[List[str], float, Tuple[str, ...]]]] = [
+    (["--help"], 15, ("requests", "environs", "dateutil", "smtplib", "utility_rate")),
+    (["preview"], 40, ("requests", "environs", "dateutil", "smtplib")),
+]
+# Each command is timed this many times and the fastest run counts, so one slow start does not fail the check
+REPEATS: Final[int] = 5
+
+_IMPORT_LINE: Final[re.Pattern] = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)")
+
+
+def measure(arguments: List[str]) -> Tuple[Dict[str, float], Set[str]]:
+    completed = subprocess.run([sys.executable, "-X", "importtime", *arguments], cwd=ROOT, capture_output=True,
+                               text=True)
+    # Cumulative milliseconds for each top level import, and every module that was imported at all
+    top_level: Dict[str, float] = {}
+    modules: Set[str] = set()
+    for line in completed.stderr.splitlines():
+        match = _IMPORT_LINE.match(line)
+        if match:
+            modules.add(match.group(4))
+            if not match.group(3):
+                top_level[match.group(4)] = int(match.group(2)) / 1000
+    return top_level, modules
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Check that quick CLI commands stay within their import budget")
+    parser.parse_args(argv)
+
+    # Modules the interpreter loads before running anything are not ours to budget
+    startup = measure(["-c", "pass"])[1]
+    failures: List[str] = []
+    for arguments, budget, forbidden in BUDGETS:
+        own_time = math.inf
+        for _ in range(REPEATS):
+            top_level, modules = measure([os.path.join(ROOT, "cli.py"), *arguments])
+            own_time = min(own_time, sum(ms for module, ms in top_level.items() if module not in startup))
+        loaded = [module for module in forbidden if any(m == module or m.startswith(f"{module}.") for m in modules)]
+        print(f"cli.py {' '.join(arguments):<10} {own_time:>7.1f} ms (budget {budget} ms)")
+
+        if own_time > budget:
+            failures.append(f"cli.py {' '.join(arguments)} took {own_time:.1f} ms to import, budget is {budget} ms")
+        if loaded:
+            failures.append(f"cli.py {' '.join(arguments)} imported {', '.join(loaded)}")
+
+    for failure in failures:
+        print(f"FAILED {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
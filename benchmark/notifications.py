@@ -0,0 +1,68 @@
+import argparse
+import json
+import sys
+import threading
+import time
+from datetime import datetime
+from typing import Final, List, Optional
+
+from benchmark.fakes import FakeSmtp
+from benchmark.run import BILLING_PERIOD, INVOICE_DATE
+from main import build_usage_email
+from notify import NotificationDispatcher, SmtpSettings, DEFAULT_SMTP_CONNECTIONS
+from utility_rate import calculate_bills, gallons_to_ccf
+
+DEFAULT_MESSAGES: Final[int] = 500
+
+
+def run_once(messages: int, connections: int, latency: float, drop_after: int) -> dict:
+    smtp = FakeSmtp(latency, drop_after)
+    threading.Thread(target=smtp.serve_forever, daemon=True).start()
+    try:
+        usage: List[int] = [800 + unit % 400 for unit in range(messages)]
+        bills = calculate_bills([gallons_to_ccf(gallons) for gallons in usage], BILLING_PERIOD)
+
+        started = time.perf_counter()
+        with NotificationDispatcher(SmtpSettings("127.0.0.1", smtp.port, starttls=False), connections,
+                                    retry_delay=0) as dispatcher:
+            for unit, gallons in enumerate(usage):
+                dispatcher.send(build_usage_email("Auto-Bill <auto-bill@example.com>", [f"unit{unit}@example.com"],
+                                                  str(1000 + unit), gallons, bills.assessed_charges(unit),
+                                                  BILLING_PERIOD, INVOICE_DATE), str(unit))
+        results = dispatcher.close()
+        wall_time = time.perf_counter() - started
+    finally:
+        smtp.shutdown()
+
+    failed = [result for result in results if not result.succeeded]
+    if failed or smtp.stats()["messages"] != messages:
+        raise RuntimeError(f"Expected {messages} emails, {len(failed)} failed and the server received "
+                           f"{smtp.stats()['messages']}")
+
+    stats = smtp.stats()
+    return {"messages": messages, "connections": connections, "wallTime": round(wall_time, 4),
+            "connectionsOpened": stats["connections"]}
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Send resident usage emails through a local SMTP stand-in")
+    parser.add_argument("--messages", type=int, default=DEFAULT_MESSAGES)
+    parser.add_argument("--connections", type=int, nargs="+", default=[1, DEFAULT_SMTP_CONNECTIONS, 4])
+    parser.add_argument("--latency", type=float, default=0.002, help="seconds the server waits per SMTP command")
+    parser.add_argument("--drop-after", type=int, default=0, help="hang up after this many messages per server")
+    parser.add_argument("--output", help="write results as JSON to this path")
+    args = parser.parse_args(argv)
+
+    results = [run_once(args.messages, connections, args.latency, args.drop_after) for connections in args.connections]
+    print(f"{'messages':>8} {'conns':>6} {'wall (s)':>10} {'opened':>8}")
+    for r in results:
+        print(f"{r['messages']:>8} {r['connections']:>6} {r['wallTime']:>10.3f} {r['connectionsOpened']:>8}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"generatedAt": datetime.now().isoformat(), "results": results}, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
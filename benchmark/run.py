@@ -0,0 +1,124 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date, datetime
+from typing import Final, List, Tuple, Optional
+
+from benchmark.fakes import FakeServerConfig, serve, PROPERTY_ID, ORGANIZATION_ID
+from main import BillingTarget, bill_property
+from next_century.client import NextCentury
+from next_century.snapshots import SnapshotStore
+from pay_hoa.client import PayHOA, DEFAULT_CHARGE_CHUNK_SIZE
+from throttle import RateLimit
+
+DEFAULT_UNIT_COUNTS: Final[Tuple[int, ...]] = (10, 100, 1000, 10000)
+BILLING_PERIOD: Final[Tuple[date, date]] = (date(2024, 1, 1), date(2024, 2, 1))
+INVOICE_DATE: Final[datetime] = datetime(2024, 2, 2)
+
+
+def run_once(units: int, latency: float, job_delay: float, chunk_size: int, client_rate: float,
+             max_rate: float = 0.0) -> dict:
+    context = multiprocessing.get_context("spawn")
+    ready, stop = context.Queue(), context.Event()
+    process = context.Process(target=serve, args=(FakeServerConfig(units, latency, job_delay, max_rate), ready, stop),
+                              daemon=True)
+    process.start()
+    try:
+        next_century_url, pay_hoa_url = ready.get(timeout=30)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            tracemalloc.start()
+            started = time.perf_counter()
+
+            next_century = NextCentury("bench@example.com", "bench",
+                                       snapshot_store=SnapshotStore(os.path.join(cache_dir, "snapshots")),
+                                       api_url=next_century_url, rate_limit=RateLimit(client_rate))
+            pay_hoa = PayHOA("bench@example.com", "bench", ORGANIZATION_ID, api_url=pay_hoa_url,
+                             rate_limit=RateLimit(client_rate))
+            result = bill_property(next_century, pay_hoa, BillingTarget(PROPERTY_ID, ORGANIZATION_ID, 1, 2),
+                                   BILLING_PERIOD, INVOICE_DATE, cache_dir, chunk_size)
+
+            wall_time = time.perf_counter() - started
+            _, peak_memory = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+    finally:
+        stop.set()
+
+    next_century_stats, pay_hoa_stats = ready.get(timeout=30)
+    process.join()
+
+    if len(result.invoiced_units) != units or pay_hoa_stats["charges"] != units:
+        raise RuntimeError(f"Expected {units} invoices, created {len(result.invoiced_units)} "
+                           f"and PayHOA received {pay_hoa_stats['charges']}")
+
+    return {
+        "units": units,
+        "wallTime": round(wall_time, 4),
+        "requests": next_century_stats["requests"] + pay_hoa_stats["requests"],
+        "peakMemory": peak_memory,
+        "nextCentury": next_century_stats,
+        "payHoa": pay_hoa_stats,
+    }
+
+
+def find_regressions(results: List[dict], baseline: List[dict], tolerance: float) -> List[str]:
+    baseline_by_units = {b["units"]: b for b in baseline}
+    regressions: List[str] = []
+    for result in results:
+        previous = baseline_by_units.get(result["units"])
+        if previous is None:
+            continue
+        for metric in ("wallTime", "requests", "peakMemory"):
+            if result[metric] > previous[metric] * (1 + tolerance):
+                regressions.append(f"{result['units']} units: {metric} {previous[metric]} -> {result[metric]}")
+
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark a bill run against local stand-in servers")
+    parser.add_argument("--units", type=int, nargs="+", default=list(DEFAULT_UNIT_COUNTS))
+    parser.add_argument("--latency", type=float, default=0.005, help="seconds added to every fake response")
+    parser.add_argument("--job-delay", type=float, default=1.0, help="seconds until a read export completes")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHARGE_CHUNK_SIZE)
+    parser.add_argument("--client-rate", type=float, default=200.0,
+                        help="requests per second the clients start at before adapting")
+    parser.add_argument("--max-rate", type=float, default=0.0,
+                        help="requests per second each fake server allows before answering 429")
+    parser.add_argument("--output", help="write results as JSON to this path")
+    parser.add_argument("--baseline", help="fail if results regress against this earlier --output file")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args(argv)
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    results: List[dict] = []
+    print(f"{'units':>8} {'wall (s)':>10} {'requests':>10} {'peak MiB':>10}")
+    for units in args.units:
+        result = run_once(units, args.latency, args.job_delay, args.chunk_size, args.client_rate, args.max_rate)
+        results.append(result)
+        print(f"{units:>8} {result['wallTime']:>10.3f} {result['requests']:>10} "
+              f"{result['peakMemory'] / 1024 / 1024:>10.2f}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
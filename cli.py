@@ -0,0 +1,119 @@
+import argparse
+import sys
+from datetime import date, timedelta
+from typing import List, Optional
+
+# Only the standard library is imported here; each command imports what it needs so that quick
+# commands such as preview never load requests, environs or the API clients.
+
+
+def configure_logging(debug: bool = False) -> None:
+    import logging
+
+    log = logging.getLogger()
+    log.setLevel(logging.DEBUG if debug else logging.INFO)
+    handler = logging.StreamHandler(sys.stdout)
+    formatter = logging.Formatter('%(asctime)s  [%(levelname)s] %(message)s')
+    handler.setFormatter(formatter)
+    log.addHandler(handler)
+
+
+def run(args: argparse.Namespace) -> None:
+    configure_logging(args.debug)
+    import main
+    main.main("run")
+
+
+def plan(args: argparse.Namespace) -> None:
+    configure_logging(args.debug)
+    import main
+    main.main("plan", args.plan_path)
+
+
+def apply(args: argparse.Namespace) -> None:
+    configure_logging(args.debug)
+    import main
+    main.main("apply", args.plan_path)
+
+
+def portfolio(args: argparse.Namespace) -> None:
+    configure_logging(args.debug)
+    import portfolio
+    portfolio.main()
+
+
+def history(args: argparse.Namespace) -> None:
+    configure_logging(args.debug)
+    from environs import Env
+    import main
+
+    env = Env()
+    env.read_env()
+    if args.action == "backfill":
+        main.backfill_history(env, args.start, args.end, args.property)
+    elif args.action == "usage":
+        main.print_usage_history(env, args.start, args.end, args.property)
+    else:
+        main.print_leak_candidates(env, args.as_of, args.recent_days, args.baseline_days, args.factor, args.property)
+
+
+def preview(args: argparse.Namespace) -> None:
+    from utility_rate import calculate_bill, gallons_to_ccf
+
+    bill = calculate_bill(args.units, gallons_to_ccf(args.gallons), (args.start, args.end))
+    for charge in bill:
+        print(f"{charge.name} ({charge.description})  ${charge.amount:,.2f}")
+    print(f"=== Total Charge ===  ${sum(c.amount for c in bill):,.2f}")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="cli.py",
+                                     description="Generate utility bills from Next Century reads in PayHOA")
+    parser.add_argument("--debug", action="store_true", help="enable debug logging")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+
+    subcommands.add_parser("run", help="compute and post this month's bills").set_defaults(handler=run)
+
+    plan_parser = subcommands.add_parser("plan", help="compute this month's bills into a plan file")
+    plan_parser.add_argument("plan_path")
+    plan_parser.set_defaults(handler=plan)
+
+    apply_parser = subcommands.add_parser("apply", help="post the bills in a plan file")
+    apply_parser.add_argument("plan_path")
+    apply_parser.set_defaults(handler=apply)
+
+    subcommands.add_parser("portfolio", help="bill every property in PORTFOLIO_FILE").set_defaults(handler=portfolio)
+
+    history_parser = subcommands.add_parser("history", help="backfill and query the local history of daily reads")
+    history_parser.add_argument("--property", help="Next Century property id, defaults to the first property")
+    history_actions = history_parser.add_subparsers(dest="action", required=True)
+    for action, help_text in (("backfill", "download reads for every day in the range the history is missing"),
+                              ("usage", "print each unit's usage between two days")):
+        action_parser = history_actions.add_parser(action, help=help_text)
+        action_parser.add_argument("start", type=date.fromisoformat)
+        action_parser.add_argument("end", type=date.fromisoformat)
+    leaks_parser = history_actions.add_parser("leaks", help="list units whose recent usage jumped")
+    leaks_parser.add_argument("--as-of", type=date.fromisoformat, default=date.today() - timedelta(days=1))
+    leaks_parser.add_argument("--recent-days", type=int, default=7)
+    leaks_parser.add_argument("--baseline-days", type=int, default=90)
+    leaks_parser.add_argument("--factor", type=float, default=3.0, help="how many times the baseline counts as a leak")
+    history_parser.set_defaults(handler=history)
+
+    preview_parser = subcommands.add_parser("preview", help="print the bill for one unit without any network calls")
+    preview_parser.add_argument("--units", type=int, default=8, help="number of units sharing fixed charges")
+    preview_parser.add_argument("--gallons", type=int, default=820, help="water used by the unit")
+    preview_parser.add_argument("--start", type=date.fromisoformat, default=date(2023, 1, 1))
+    preview_parser.add_argument("--end", type=date.fromisoformat, default=date(2023, 2, 1))
+    preview_parser.set_defaults(handler=preview)
+
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    args.handler(args)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,161 @@
+import base64
+import json
+import threading
+import time
+from abc import ABCMeta, abstractmethod
+from functools import partial
+from http.cookiejar import CookieJar
+from typing import Final, Callable, Collection, Dict, List, NamedTuple, Optional
+
+from requests import PreparedRequest, Response
+from requests.auth import AuthBase
+from requests.cookies import create_cookie
+
+from files import atomic_write
+from metrics import METRICS
+
+# Tokens without a readable expiry are reused for this long before logging in again
+CREDENTIAL_TTL: Final[float] = 12 * 60 * 60
+# Credentials this close to expiring are treated as expired so a run does not start with a dying token
+EXPIRY_MARGIN: Final[float] = 60
+
+
+class Credentials(NamedTuple):
+    token: str
+    cookies: List[dict]
+    expires_at: float
+
+
+def token_expiry(token: str, now: Optional[float] = None) -> float:
+    # Both APIs hand out JWTs; use their exp claim when there is one
+    now = time.time() if now is None else now
+    try:
+        payload = token.removeprefix("Bearer ").split(".")[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+        return float(claims["exp"])
+    except (IndexError, ValueError, KeyError, TypeError):
+        return now + CREDENTIAL_TTL
+
+
+def dump_cookies(jar: CookieJar) -> List[dict]:
+    return [{"name": cookie.name, "value": cookie.value, "domain": cookie.domain, "path": cookie.path,
+             "expires": cookie.expires, "secure": cookie.secure} for cookie in jar]
+
+
+def load_cookies(jar: CookieJar, cookies: List[dict]) -> None:
+    for cookie in cookies:
+        jar.set_cookie(create_cookie(**cookie))
+    jar.clear_expired_cookies()
+
+
+def latest_cookie(jar: CookieJar, name: str) -> Optional[str]:
+    # The same cookie can be set for several domains or paths; the last one set wins
+    value = None
+    for cookie in jar:
+        if cookie.name == name:
+            value = cookie.value
+    return value
+
+
+class CredentialStore:
+    # Login tokens and session cookies keyed by API and account, so frequent runs can skip logging in.
+    # The file holds live credentials and is only readable by its owner.
+    def __init__(self, path: str) -> None:
+        self.path: Final[str] = path
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def __key(api_url: str, email: str) -> str:
+        return f"{api_url}|{email.lower()}"
+
+    def __read(self) -> Dict[str, dict]:
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            # A corrupt store only costs a login
+            return {}
+
+    def __write(self, entries: Dict[str, dict]) -> None:
+        with atomic_write(self.path, permissions=0o600) as f:
+            json.dump(entries, f, separators=(",", ":"))
+
+    def get(self, api_url: str, email: str) -> Optional[Credentials]:
+        with self.__lock:
+            entry = self.__read().get(self.__key(api_url, email))
+        if entry is None or entry["expiresAt"] - EXPIRY_MARGIN <= time.time():
+            return None
+        return Credentials(entry["token"], entry["cookies"], entry["expiresAt"])
+
+    def put(self, api_url: str, email: str, credentials: Credentials) -> None:
+        with self.__lock:
+            entries = self.__read()
+            now = time.time()
+            entries = {key: entry for key, entry in entries.items() if entry["expiresAt"] > now}
+            entries[self.__key(api_url, email)] = {"token": credentials.token, "cookies": credentials.cookies,
+                                                   "expiresAt": credentials.expires_at}
+            self.__write(entries)
+
+
+class SessionAuth(AuthBase, metaclass=ABCMeta):
+    # Adds credentials to requests for the API and, when the API rejects them, logs in again once and
+    # resends the request. Requests to other hosts, such as pre-signed downloads, are left alone.
+    def __init__(self, api_url: str, cookies: CookieJar, login: Callable[[int], None], service: str,
+                 rejected_statuses: Collection[int] = (401,)) -> None:
+        self.api_url: Final[str] = api_url
+        self.cookies: Final[CookieJar] = cookies
+        self.service: Final[str] = service
+        self.generation = 0
+        self.__login = login
+        self.__rejected_statuses = rejected_statuses
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+
+    @abstractmethod
+    def add_credentials(self, request: PreparedRequest) -> None:
+        pass
+
+    def __call__(self, request: PreparedRequest) -> PreparedRequest:
+        if request.url.startswith(self.api_url):
+            self.add_credentials(request)
+            # Requests made while logging in must not trigger another login
+            if not getattr(self.__local, "logging_in", False):
+                request.register_hook("response", partial(self.__handle_response, self.generation))
+        return request
+
+    def authenticate(self, status_code: int = 401) -> None:
+        self.__refresh(status_code, self.generation)
+
+    def __refresh(self, status_code: int, generation: int) -> None:
+        with self.__lock:
+            # Another thread already logged in again after this request was sent
+            if generation != self.generation:
+                return
+            self.__local.logging_in = True
+            try:
+                self.__login(status_code)
+            finally:
+                self.__local.logging_in = False
+            self.generation += 1
+
+    def __handle_response(self, generation: int, response: Response, **kwargs) -> Response:
+        if response.status_code not in self.__rejected_statuses:
+            return response
+
+        METRICS.increment("reauthentications", service=self.service, status=str(response.status_code))
+        # Release the connection before logging in
+        response.content
+        response.close()
+        self.__refresh(response.status_code, generation)
+
+        retry = response.request.copy()
+        retry.headers.pop("Cookie", None)
+        retry.prepare_cookies(self.cookies)
+        self.add_credentials(retry)
+
+        resent = response.connection.send(retry, **kwargs)
+        resent.history.append(response)
+        resent.request = retry
+        return resent
@@ -0,0 +1,25 @@
+import os
+import tempfile
+from contextlib import contextmanager
+from typing import IO, Iterator, Optional
+
+
+@contextmanager
+def atomic_write(path: str, mode: str = "w", permissions: Optional[int] = None) -> Iterator[IO]:
+    # Writes to a temporary file next to path and moves it into place once the block finishes, so readers see
+    # either the old file or the whole new one. If the block fails, the temporary file is removed.
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode) as f:
+            if permissions is not None:
+                os.chmod(temp_path, permissions)
+            yield f
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except FileNotFoundError:
+            pass
+        raise
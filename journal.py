@@ -0,0 +1,90 @@
+import json
+import os
+from datetime import date
+from typing import Final, Dict, List, Optional, Set, Tuple
+
+
+class RunJournal:
+    # Append-only JSON lines, one file per billing period and target. Each line is one of
+    #   {"type": "usage", "usage": {unit: gallons}, "dailyUsage": {unit: [gallons on each day]} or null,
+    #    "meterCount": meters at the property, "skipped": {unit: why its meter could not be billed}}
+    #   {"type": "charge", "unit": unit, "charge": Charge.to_dict()}
+    #   {"type": "submitted", "unit": unit}
+    #   {"type": "notified", "unit": unit}
+    # Replaying the lines in order restores the state of an interrupted run. Without a path the
+    # journal only tracks the current run in memory.
+    def __init__(self, path: Optional[str] = None) -> None:
+        self.path: Final[Optional[str]] = path
+        self.usage: Optional[Dict[str, float]] = None
+        self.daily_usage: Optional[Dict[str, List[float]]] = None
+        self.meter_count: Optional[int] = None
+        self.skipped_units: Dict[str, str] = {}
+        self.charges: Dict[str, dict] = {}
+        self.submitted_units: Set[str] = set()
+        self.notified_units: Set[str] = set()
+
+        if path is None or not os.path.exists(path):
+            return
+
+        with open(path) as f:
+            lines = f.read().splitlines()
+
+        for number, line in enumerate(lines):
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                if number != len(lines) - 1:
+                    raise
+                # Only the final line can be torn by a crash mid-write; drop it so new entries start cleanly
+                with open(path, "w") as f:
+                    f.writelines(line + "\n" for line in lines[:-1])
+                break
+            self.__apply(entry)
+
+    @staticmethod
+    def for_period(directory: str, property_id: str, organization_id: int,
+                   billing_period: Tuple[date, date]) -> 'RunJournal':
+        start, end = billing_period
+        return RunJournal(os.path.join(directory, f"{organization_id}-{property_id}-{start.isoformat()}-"
+                                                  f"{end.isoformat()}.jsonl"))
+
+    def __apply(self, entry: dict) -> None:
+        if entry["type"] == "usage":
+            self.usage = entry["usage"]
+            self.daily_usage = entry.get("dailyUsage")
+            self.meter_count = entry.get("meterCount")
+            self.skipped_units = entry.get("skipped") or {}
+        elif entry["type"] == "charge":
+            self.charges[entry["unit"]] = entry["charge"]
+        elif entry["type"] == "submitted":
+            self.submitted_units.add(entry["unit"])
+        elif entry["type"] == "notified":
+            self.notified_units.add(entry["unit"])
+        else:
+            raise ValueError(f"Unexpected journal entry type: {entry['type']}")
+
+    def __append(self, *entries: dict) -> None:
+        if self.path is not None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "a") as f:
+                for entry in entries:
+                    f.write(json.dumps(entry, separators=(",", ":")) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+        for entry in entries:
+            self.__apply(entry)
+
+    def record_usage(self, usage: Dict[str, float], daily_usage: Optional[Dict[str, List[float]]] = None,
+                     meter_count: Optional[int] = None, skipped_units: Optional[Dict[str, str]] = None) -> None:
+        self.__append({"type": "usage", "usage": usage, "dailyUsage": daily_usage, "meterCount": meter_count,
+                       "skipped": skipped_units or {}})
+
+    def record_charges(self, charges: Dict[str, dict]) -> None:
+        self.__append(*({"type": "charge", "unit": unit, "charge": charge} for unit, charge in charges.items()))
+
+    def record_submitted(self, *units: str) -> None:
+        self.__append(*({"type": "submitted", "unit": unit} for unit in units))
+
+    def record_notified(self, *units: str) -> None:
+        self.__append(*({"type": "notified", "unit": unit} for unit in units))
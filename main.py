@@ -1,25 +1,33 @@
 import json
 import logging
+import math
+import os
 import sys
 from datetime import timedelta, date, datetime
 from email.message import EmailMessage
 from textwrap import dedent
-from typing import Final, Dict, List
+from typing import Final, Callable, Dict, List, NamedTuple, Optional, Tuple
 
 from environs import Env
 
 import notify
-from next_century.client import NextCentury
-from pay_hoa.client import PayHOA
+from credentials import CredentialStore
+from journal import RunJournal
+from metadata import MetadataCache, METADATA_TTL
+from metrics import METRICS
+from next_century.client import NextCentury, DEFAULT_POOL_SIZE, ALL_WATER, READ_POLL_DEADLINE, \
+    DEFAULT_RATE_LIMIT as NEXT_CENTURY_RATE_LIMIT
+from next_century.diff import diff_snapshots, ReadFlag, UNUSABLE
+from next_century.history import ReadHistory
+from next_century.snapshots import SnapshotStore, DEFAULT_MAX_BYTES
+from next_century.units import UnitDirectory
+from pay_hoa.client import PayHOA, DEFAULT_CHARGE_CHUNK_SIZE, DEFAULT_RATE_LIMIT as PAY_HOA_RATE_LIMIT
 from pay_hoa.shapes import CreateChargeRequest, Charge, LateFee
-from utility_rate import calculate_bill, gallons_to_ccf, AssessedCharge
+from pipeline import Pipeline
+from plan import write_plan, read_plan
+from utility_rate import calculate_bills, gallons_to_ccf, AssessedCharge, BillMatrix
 
 log = logging.getLogger()
-log.setLevel(logging.INFO)
-handler = logging.StreamHandler(sys.stdout)
-formatter = logging.Formatter('%(asctime)s  [%(levelname)s] %(message)s')
-handler.setFormatter(formatter)
-log.addHandler(handler)
 
 BILLING_DATE_OVERRIDES: Dict[date, date] = {
     date(2026, 6, 1): date(2026, 6, 5)
@@ -35,62 +43,138 @@ def get_start_of_this_month() -> date:
     return BILLING_DATE_OVERRIDES.get(date.today().replace(day=1), date.today().replace(day=1))
 
 
-def get_required_read_for_date(next_century: NextCentury, property_id: str, target_date: date):
-    reads = next_century.get_daily_read_for_property(property_id, target_date)
-    if reads:
-        return reads
+def get_required_reads_for_dates(next_century: NextCentury, property_id: str, target_dates: List[date]):
+    reads_by_date = next_century.get_reads_by_unit(property_id, target_dates, ALL_WATER)
+    for target_date in target_dates:
+        if not reads_by_date.get(target_date):
+            raise ValueError(
+                f"No NextCentury reads found for required billing date {target_date.strftime('%m/%d/%Y')}"
+            )
 
-    raise ValueError(
-        f"No NextCentury reads found for required billing date {target_date.strftime('%m/%d/%Y')}"
-    )
+    return reads_by_date
 
 
-def generate_usage_by_unit(next_century: NextCentury, billing_period_start: date, billing_period_end: date):
-    property_id: Final[str] = next_century.get_first_property_id()
+def daily_usage_between(reads_by_date: Dict[date, Dict[str, int]], unit: str, start: date, end: date) -> List[float]:
+    # Usage on each day from start up to end. Days without a read share the usage between the reads on either
+    # side evenly, so the days always add up to the period's usage.
+    known: List[Tuple[int, int]] = [(n, reads_by_date[start + timedelta(days=n)][unit])
+                                    for n in range((end - start).days + 1)
+                                    if unit in reads_by_date.get(start + timedelta(days=n), {})]
+    daily_usage: List[float] = []
+    for (n_before, read_before), (n_after, read_after) in zip(known, known[1:]):
+        daily_usage.extend([(read_after - read_before) / (n_after - n_before)] * (n_after - n_before))
+    return daily_usage
 
-    beginning_read = get_required_read_for_date(next_century, property_id, billing_period_start)
-    beginning_read_by_unit = {d["unitId"]: d["meterRead"]["computed"] for d in beginning_read if
-                              d.get("meterRead", {}).get("utilityTypeId") == 5}  # 5 is the code for ALL_WATER
-    ending_read = get_required_read_for_date(next_century, property_id, billing_period_end)
-    ending_read_by_unit = {d["unitId"]: d["meterRead"]["computed"] for d in ending_read if
-                              d.get("meterRead", {}).get("utilityTypeId") == 5}  # 5 is the code for ALL_WATER
-    usage_by_unit_id = {unit: ending_read_by_unit[unit] - beginning_read_by_unit[unit] for unit in
-                        ending_read_by_unit.keys()}
-    return {next_century.get_unit(property_id, unit)['name']: usage for unit, usage in
-            usage_by_unit_id.items()}
 
+def get_billing_period_reads(next_century: NextCentury, property_id: str, billing_period_start: date,
+                             billing_period_end: date) -> Tuple[Dict[date, Dict[str, int]], bool]:
+    # Returns the reads for the period and whether they came from the range export with every day in it
+    reads_by_date = next_century.get_reads_for_range(property_id, billing_period_start, billing_period_end,
+                                                     ALL_WATER)
+    has_daily_reads = bool(reads_by_date.get(billing_period_start) and reads_by_date.get(billing_period_end))
+    if not has_daily_reads:
+        log.warning("Next Century's range export did not include both ends of the billing period, "
+                    "billing seasonal usage as if it were spread evenly")
+        reads_by_date = get_required_reads_for_dates(next_century, property_id,
+                                                     [billing_period_start, billing_period_end])
+    return reads_by_date, has_daily_reads
 
-def main():
-    env = Env()
-    env.read_env()
-    with env.prefixed("NEXT_CENTURY_"):
-        next_century = NextCentury(env.str("EMAIL"), env.str("PASSWORD"))
-        log.info(f"Logged in to Next Century as {env.str('EMAIL')}")
-    with env.prefixed("PAY_HOA_"):
-        pay_hao_organization_id = env.int("ORGANIZATION_ID")
-        deposit_bank_account_id = env.int("DEPOSIT_ACCOUNT")
-        category_id = env.int("CATEGORY_ID")
-        pay_hoa = PayHOA(env.str("EMAIL"), env.str("PASSWORD"), pay_hao_organization_id)
-        log.info(f"Logged in to PayHOA as {env.str('EMAIL')} in {env.int('ORGANIZATION_ID')}")
-    start_of_last_month: Final[date] = get_start_of_last_month()
-    start_of_this_month: Final[date] = get_start_of_this_month()
-    log.info(
-        f"Starting Bill Generation for Period {start_of_last_month.strftime('%m/%d/%Y')} - {start_of_this_month.strftime('%m/%d/%Y')}")
-    usage_by_unit: Dict[str, int] = generate_usage_by_unit(next_century, start_of_last_month, start_of_this_month)
-    log.info("Obtained usage by unit")
-    address_to_pay_hoa_id: Dict[str, int] = {unit["address"]["line1"].split(" ")[0]: unit["id"] for unit in
-                                             pay_hoa.list_units()}
-    invoice_date: datetime = datetime.now() + timedelta(days=1)
+
+class PeriodUsage(NamedTuple):
+    usage_by_unit: Dict[str, float]
+    # Each unit's usage on every day of the period, when the export had every day
+    daily_usage_by_unit: Optional[Dict[str, List[float]]]
+    # Every meter at the property, billed or not; fixed charges are split across all of them
+    meter_count: int
+    # Units left unbilled because their meters could not be read, with the reason
+    skipped_units: Dict[str, str]
+
+
+def generate_usage_by_unit(reads_by_date: Dict[date, Dict[str, int]], has_daily_reads: bool,
+                           unit_directory: UnitDirectory, billing_period_start: date,
+                           billing_period_end: date) -> PeriodUsage:
+    # Units whose meters cannot be billed are reported and left out rather than failing the whole property
+    diff = diff_snapshots(reads_by_date[billing_period_start], reads_by_date[billing_period_end])
+    # Meters Next Century does not list under the property are reported by id
+    names = {unit: (unit_directory.get(unit) or {}).get("name", unit) for unit in diff.unit_ids}
+    skipped_units: Dict[str, str] = {}
+    for unit, flag in diff.flagged():
+        name = names[unit]
+        METRICS.increment("meter_anomalies", flag=flag.name)
+        if flag & UNUSABLE:
+            log.error(f"Not billing {name}: {flag.name} reading between {billing_period_start} and "
+                      f"{billing_period_end}")
+            skipped_units[name] = f"{flag.name} reading"
+        else:
+            log.warning(f"Meter for {name} rolled over between {billing_period_start} and {billing_period_end}")
+    usage_by_unit_id = diff.usage_by_unit()
+    for unit in [unit for unit in usage_by_unit_id if unit_directory.get(unit) is None]:
+        log.error(f"Not billing meter {unit}: it is not one of the property's units")
+        skipped_units[unit] = "unknown unit"
+        del usage_by_unit_id[unit]
+    usage_by_unit = {names[unit]: usage for unit, usage in usage_by_unit_id.items()}
+    if not has_daily_reads:
+        return PeriodUsage(usage_by_unit, None, len(diff), skipped_units)
+
+    # Day by day reads across a rollover would show one large negative day, so spread those units evenly
+    days = (billing_period_end - billing_period_start).days
+    rolled_over = {unit for unit, flag in diff.flagged() if flag & ReadFlag.ROLLOVER}
+    return PeriodUsage(usage_by_unit, {
+        names[unit]: [usage / days] * days if unit in rolled_over else
+        daily_usage_between(reads_by_date, unit, billing_period_start, billing_period_end)
+        for unit, usage in usage_by_unit_id.items()
+    }, len(diff), skipped_units)
+
+
+def calculate_unit_bills(usage_by_unit: Dict[str, float], daily_usage_by_unit: Optional[Dict[str, List[float]]],
+                         billing_period: Tuple[date, date], meter_count: Optional[int] = None) \
+        -> Tuple[List[str], BillMatrix]:
+    units: List[str] = list(usage_by_unit.keys())
+    daily_usage = [[gallons_to_ccf(gallons) for gallons in daily_usage_by_unit[unit]] for unit in units] \
+        if daily_usage_by_unit is not None else None
+    return units, calculate_bills([gallons_to_ccf(usage_by_unit[unit]) for unit in units], billing_period,
+                                  daily_usage, meter_count)
+
+
+class BillingTarget(NamedTuple):
+    property_id: str
+    organization_id: int
+    # Only needed to build charges; charges read from a plan already carry them
+    deposit_bank_account_id: Optional[int] = None
+    category_id: Optional[int] = None
+
+
+class BillRunResult(NamedTuple):
+    target: BillingTarget
+    invoiced_units: List[str]
+    failed_units: List[str]
+    # Units that were not billed at all because their meters could not be read, with the reason
+    skipped_units: Dict[str, str]
+    error: Optional[str] = None
+
+    @property
+    def succeeded(self) -> bool:
+        return self.error is None and not self.failed_units
+
+    @property
+    def needs_attention(self) -> bool:
+        return not self.succeeded or bool(self.skipped_units)
+
+
+def build_charges(late_fee_category_id: int, target: BillingTarget, usage_by_unit: Dict[str, float],
+                  address_to_pay_hoa_id: Dict[str, int], billing_period: Tuple[date, date],
+                  invoice_date: datetime, daily_usage_by_unit: Optional[Dict[str, List[float]]] = None,
+                  meter_count: Optional[int] = None) -> Dict[str, Charge]:
     payment_due: datetime = invoice_date.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=31)
     late_after: datetime = payment_due + timedelta(days=15)
-    for unit, usage in usage_by_unit.items():
-        charges: List[AssessedCharge] = calculate_bill(number_of_units=len(usage_by_unit.keys()),
-                                                       water_usage=gallons_to_ccf(usage),
-                                                       metering_period=(start_of_last_month, start_of_this_month))
-
-        charge_request = CreateChargeRequest(charges=[Charge(
-            deposit_bank_account_id=deposit_bank_account_id,
-            category_id=category_id,
+    unit_charges: Dict[str, Charge] = {}
+    units, bills = calculate_unit_bills(usage_by_unit, daily_usage_by_unit, billing_period, meter_count)
+    for unit_index, unit in enumerate(units):
+        charges: List[AssessedCharge] = bills.assessed_charges(unit_index)
+
+        unit_charges[unit] = Charge(
+            deposit_bank_account_id=target.deposit_bank_account_id,
+            category_id=target.category_id,
             title="Utilities",
             description="\n".join([f"{c.name} ({c.description}) - ${c.amount:.2f}" for c in charges]),
             email_append_message="",
@@ -104,32 +188,301 @@ def main():
                     one_time_late_fee_type="flat",
                     one_time_late_fee_applies=late_after,
                     one_time_late_fee_amount=1500,
-                    category_id=pay_hoa.get_late_fee_category_id()
+                    category_id=late_fee_category_id
                 )
             ],
             reason="",
             email_invoice=1,
             payor_id=address_to_pay_hoa_id[unit],
             payor_type="unit"
-        )],
-            templates=[],
-            invoice_message=f"Bill based on usage between {start_of_last_month.strftime('%m/%d/%Y')} and"
-                            f" {start_of_this_month.strftime('%m/%d/%Y')}",
-            payor_type="unit",
-            organization_id=pay_hao_organization_id)
-        log.debug(json.dumps(charge_request.to_dict(), indent=2, sort_keys=True))
-
-        pay_hoa.create_charge(charge_request)
-        log.info(f"Invoice created for {unit}")
+        )
+
+    return unit_charges
+
+
+def build_charge_request(target: BillingTarget, charges: List[Charge],
+                         billing_period: Tuple[date, date]) -> CreateChargeRequest:
+    start_of_last_month, start_of_this_month = billing_period
+    return CreateChargeRequest(
+        charges=charges,
+        templates=[],
+        invoice_message=f"Bill based on usage between {start_of_last_month.strftime('%m/%d/%Y')} and"
+                        f" {start_of_this_month.strftime('%m/%d/%Y')}",
+        payor_type="unit",
+        organization_id=target.organization_id)
+
+
+def payor_ids(pay_hoa: PayHOA, ttl: Optional[float] = None) -> Dict[str, int]:
+    # PayHOA units are addressed by their unit number
+    return {unit["address"]["line1"].split(" ")[0]: unit["id"] for unit in pay_hoa.list_units(ttl=ttl)}
+
+
+def add_charge_stages(pipeline: Pipeline, billing_period: Tuple[date, date], invoice_date: datetime,
+                      cache_dir: str) -> Pipeline:
+    # Adds the stages that turn reads into charges to a pipeline that provides "next_century", "pay_hoa",
+    # "target" and "journal". The PayHOA lookups run while Next Century is still exporting reads, and
+    # stages whose results are already in the journal return None.
+    def charges_pending(journal: RunJournal) -> bool:
+        return journal.usage is None or any(unit not in journal.charges for unit in journal.usage)
+
+    def unit_directory_path(target: BillingTarget) -> str:
+        return os.path.join(cache_dir, "units", f"{target.property_id}.json")
+
+    def unit_directory(next_century: NextCentury, target: BillingTarget, journal: RunJournal) \
+            -> Optional[UnitDirectory]:
+        if journal.usage is not None:
+            return None
+        with METRICS.span("phase", phase="unit_resolution"):
+            return next_century.get_unit_directory(target.property_id, unit_directory_path(target))
+
+    def reads(next_century: NextCentury, target: BillingTarget, journal: RunJournal) \
+            -> Optional[Tuple[Dict[date, Dict[str, int]], bool]]:
+        if journal.usage is not None:
+            return None
+        with METRICS.span("phase", phase="usage"):
+            return get_billing_period_reads(next_century, target.property_id, *billing_period)
+
+    def usage(next_century: NextCentury, target: BillingTarget, journal: RunJournal,
+              directory: Optional[UnitDirectory],
+              period_reads: Optional[Tuple[Dict[date, Dict[str, int]], bool]]) -> Dict[str, float]:
+        if journal.usage is not None:
+            log.info(f"Resuming property {target.property_id} with usage from {journal.path}")
+            return journal.usage
+        reads_by_date, _ = period_reads
+        if any(directory.get(unit) is None for day in billing_period for unit in reads_by_date[day]):
+            # The saved unit list may predate a unit that has reads now. It is fetched again once; meters that
+            # are still unknown are reported rather than billed.
+            with METRICS.span("phase", phase="unit_resolution"):
+                directory = next_century.get_unit_directory(target.property_id, unit_directory_path(target), ttl=0)
+        period_usage = generate_usage_by_unit(*period_reads, directory, *billing_period)
+        journal.record_usage(*period_usage)
+        log.info(f"Obtained usage by unit for property {target.property_id}")
+        return period_usage.usage_by_unit
+
+    def payors(pay_hoa: PayHOA, journal: RunJournal) -> Optional[Dict[str, int]]:
+        if not charges_pending(journal):
+            return None
+        with METRICS.span("phase", phase="unit_resolution"):
+            return payor_ids(pay_hoa)
+
+    def late_fee_category(pay_hoa: PayHOA, journal: RunJournal) -> Optional[int]:
+        return pay_hoa.get_late_fee_category_id() if charges_pending(journal) else None
+
+    def charges(pay_hoa: PayHOA, target: BillingTarget, journal: RunJournal, usage_by_unit: Dict[str, float],
+                address_to_pay_hoa_id: Optional[Dict[str, int]], late_fee_category_id: Optional[int]) \
+            -> Dict[str, Charge]:
+        if any(unit not in journal.charges for unit in usage_by_unit):
+            if any(unit not in address_to_pay_hoa_id for unit in usage_by_unit):
+                # The saved unit list predates a unit that has usage now
+                with METRICS.span("phase", phase="unit_resolution"):
+                    address_to_pay_hoa_id = payor_ids(pay_hoa, ttl=0)
+            with METRICS.span("phase", phase="charge_building"):
+                built = build_charges(late_fee_category_id, target, usage_by_unit, address_to_pay_hoa_id,
+                                      billing_period, invoice_date, journal.daily_usage, journal.meter_count)
+            journal.record_charges({unit: charge.to_dict() for unit, charge in built.items()
+                                    if unit not in journal.charges})
+
+        return {unit: Charge.from_dict(journal.charges[unit]) for unit in usage_by_unit}
+
+    return pipeline \
+        .stage("unit_directory", unit_directory, "next_century", "target", "journal") \
+        .stage("reads", reads, "next_century", "target", "journal") \
+        .stage("usage", usage, "next_century", "target", "journal", "unit_directory", "reads") \
+        .stage("payors", payors, "pay_hoa", "journal") \
+        .stage("late_fee_category", late_fee_category, "pay_hoa", "journal") \
+        .stage("charges", charges, "pay_hoa", "target", "journal", "usage", "payors", "late_fee_category")
+
+
+def prepare_charges(next_century: NextCentury, pay_hoa: PayHOA, target: BillingTarget,
+                    billing_period: Tuple[date, date], invoice_date: datetime, cache_dir: str,
+                    journal: RunJournal) -> Dict[str, Charge]:
+    pipeline = Pipeline() \
+        .value("next_century", next_century) \
+        .value("pay_hoa", pay_hoa) \
+        .value("target", target) \
+        .value("journal", journal)
+    return add_charge_stages(pipeline, billing_period, invoice_date, cache_dir).run()["charges"]
+
+
+def submit_charges(pay_hoa: PayHOA, charge_request: CreateChargeRequest, units: List[str], target: BillingTarget,
+                   chunk_size: int, journal: RunJournal, skipped_units: Optional[Dict[str, str]] = None) \
+        -> BillRunResult:
+    # units[i] is the unit billed by charge_request.charges[i]. Units left without a charge are reported from
+    # skipped_units, or from the journal's usage when not given.
+    pending = [(unit, charge) for unit, charge in zip(units, charge_request.charges)
+               if unit not in journal.submitted_units]
+    if len(pending) < len(units):
+        log.info(f"Skipping {len(units) - len(pending)} units that were already invoiced")
+
+    # The journal only knows about this run's submissions; PayHOA knows about every charge issued for the period
+    issued_charges = pay_hoa.index_issued_charges([charge for _, charge in pending])
+    already_issued = [unit for unit, charge in pending if charge in issued_charges]
+    if already_issued:
+        log.info(f"Skipping {len(already_issued)} units that PayHOA already has this charge for")
+        METRICS.increment("pay_hoa_charges", len(already_issued), outcome="already_issued")
+        journal.record_submitted(*already_issued)
+        pending = [(unit, charge) for unit, charge in pending if charge not in issued_charges]
+
+    unit_by_payor_id: Dict[int, str] = {charge.payor_id: unit for unit, charge in pending}
+    pending_request = CreateChargeRequest(charges=[charge for _, charge in pending],
+                                          templates=charge_request.templates,
+                                          invoice_message=charge_request.invoice_message,
+                                          payor_type=charge_request.payor_type,
+                                          organization_id=charge_request.organization_id)
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug(json.dumps(pending_request.to_dict(), indent=2, sort_keys=True))
+
+    failed_units: List[str] = []
+    with METRICS.span("phase", phase="charge_submission"):
+        for chunk_results in pay_hoa.iter_create_charges(pending_request, chunk_size):
+            submitted_units: List[str] = []
+            for result in chunk_results:
+                unit = unit_by_payor_id[result.charge.payor_id]
+                if result.succeeded:
+                    log.info(f"Invoice created for {unit}")
+                    submitted_units.append(unit)
+                else:
+                    log.error(f"Invoice failed for {unit}: {result.error}")
+                    failed_units.append(unit)
+            journal.record_submitted(*submitted_units)
+
+    invoiced_units = [unit for unit in units if unit in journal.submitted_units]
+    return BillRunResult(target, invoiced_units, failed_units,
+                         journal.skipped_units if skipped_units is None else skipped_units)
+
+
+def bill_property(next_century: NextCentury, pay_hoa: PayHOA, target: BillingTarget,
+                  billing_period: Tuple[date, date], invoice_date: datetime, cache_dir: str,
+                  chunk_size: int = DEFAULT_CHARGE_CHUNK_SIZE, journal: Optional[RunJournal] = None) -> BillRunResult:
+    journal = journal or RunJournal()
+    charges = prepare_charges(next_century, pay_hoa, target, billing_period, invoice_date, cache_dir, journal)
+    return submit_charges(pay_hoa, build_charge_request(target, list(charges.values()), billing_period),
+                          list(charges.keys()), target, chunk_size, journal)
+
+
+def get_billing_period() -> Tuple[date, date]:
+    return get_start_of_last_month(), get_start_of_this_month()
+
+
+def get_invoice_date() -> datetime:
+    return datetime.now() + timedelta(days=1)
+
+
+def write_metrics(env: Env) -> None:
+    METRICS.write(env.str("METRICS_JSON", "bill-run-metrics.json"),
+                  env.str("METRICS_PROMETHEUS", "bill-run-metrics.prom"))
+    log.info("Run metrics written")
+
+
+def credential_store_for(env: Env, cache_dir: str) -> Optional[CredentialStore]:
+    # Saved logins let back to back runs skip logging in; CREDENTIAL_CACHE=false always logs in
+    if not env.bool("CREDENTIAL_CACHE", True):
+        return None
+    return CredentialStore(os.path.join(cache_dir, "credentials.json"))
+
+
+def metadata_cache_for(env: Env, cache_dir: str) -> Optional[MetadataCache]:
+    # Properties, units and categories are kept between runs; METADATA_CACHE=false fetches them every run
+    if not env.bool("METADATA_CACHE", True):
+        return None
+    return MetadataCache(os.path.join(cache_dir, "metadata"), env.float("METADATA_TTL", METADATA_TTL))
+
+
+def history_directory_for(env: Env, cache_dir: str) -> str:
+    return env.str("HISTORY_DIR", os.path.join(cache_dir, "history"))
+
+
+def next_century_login(env: Env, cache_dir: str) -> Callable[[], NextCentury]:
+    # Settings are read now so the login itself can run on another thread; Env prefixes are not thread safe
+    credential_store = credential_store_for(env, cache_dir)
+    metadata_cache = metadata_cache_for(env, cache_dir)
+    history_directory = history_directory_for(env, cache_dir)
+    with env.prefixed("NEXT_CENTURY_"):
+        email, password, pool_size = env.str("EMAIL"), env.str("PASSWORD"), env.int("POOL_SIZE", DEFAULT_POOL_SIZE)
+        rate_limit = NEXT_CENTURY_RATE_LIMIT._replace(rate=env.float("RATE_LIMIT", NEXT_CENTURY_RATE_LIMIT.rate))
+        read_deadline = env.float("READ_DEADLINE", READ_POLL_DEADLINE)
+        snapshot_store = SnapshotStore(os.path.join(cache_dir, "snapshots"),
+                                       env.int("SNAPSHOT_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES))
+
+    def login() -> NextCentury:
+        with METRICS.span("phase", phase="login", service="next_century"):
+            next_century = NextCentury(email, password, pool_size, snapshot_store,
+                                       credential_store=credential_store, history_directory=history_directory,
+                                       rate_limit=rate_limit, metadata_cache=metadata_cache,
+                                       read_deadline=read_deadline)
+        log.info(f"Logged in to Next Century as {email}")
+        return next_century
+
+    return login
+
+
+def pay_hoa_login(env: Env, organization_id: int, cache_dir: str) -> Callable[[], PayHOA]:
+    credential_store = credential_store_for(env, cache_dir)
+    metadata_cache = metadata_cache_for(env, cache_dir)
+    with env.prefixed("PAY_HOA_"):
+        email, password = env.str("EMAIL"), env.str("PASSWORD")
+        rate_limit = PAY_HOA_RATE_LIMIT._replace(rate=env.float("RATE_LIMIT", PAY_HOA_RATE_LIMIT.rate))
+
+    def login() -> PayHOA:
+        with METRICS.span("phase", phase="login", service="pay_hoa"):
+            pay_hoa = PayHOA(email, password, organization_id, credential_store=credential_store,
+                             rate_limit=rate_limit, metadata_cache=metadata_cache)
+        log.info(f"Logged in to PayHOA as {email} in {organization_id}")
+        return pay_hoa
+
+    return login
+
+
+def login_next_century(env: Env, cache_dir: str) -> NextCentury:
+    return next_century_login(env, cache_dir)()
+
+
+def login_pay_hoa(env: Env, organization_id: int, cache_dir: str) -> PayHOA:
+    return pay_hoa_login(env, organization_id, cache_dir)()
+
+
+def target_from_env(env: Env, next_century: NextCentury) -> BillingTarget:
+    with env.prefixed("PAY_HOA_"):
+        return BillingTarget(next_century.get_first_property_id(), env.int("ORGANIZATION_ID"),
+                             env.int("DEPOSIT_ACCOUNT"), env.int("CATEGORY_ID"))
+
+
+def journal_for(env: Env, target: BillingTarget, billing_period: Tuple[date, date]) -> RunJournal:
+    return RunJournal.for_period(env.str("JOURNAL_DIR", "journal"), target.property_id, target.organization_id,
+                                 billing_period)
+
+
+def charge_pipeline(env: Env, cache_dir: str, billing_period: Tuple[date, date],
+                    invoice_date: datetime) -> Pipeline:
+    # Logs in to both services at once and prepares charges for the property in the environment. The logins
+    # read their settings here; only the target and then the journal read the environment on a stage thread.
+    pipeline = Pipeline() \
+        .stage("next_century", next_century_login(env, cache_dir)) \
+        .stage("pay_hoa", pay_hoa_login(env, env.int("PAY_HOA_ORGANIZATION_ID"), cache_dir)) \
+        .stage("target", lambda next_century: target_from_env(env, next_century), "next_century") \
+        .stage("journal", lambda target: journal_for(env, target, billing_period), "target")
+    return add_charge_stages(pipeline, billing_period, invoice_date, cache_dir)
+
+
+def describe_skipped_units(skipped_units: Dict[str, str]) -> str:
+    return ", ".join(f"{unit} ({reason})" for unit, reason in sorted(skipped_units.items()))
+
+
+def send_completion_email(env: Env, billing_period: Tuple[date, date], invoice_date: datetime,
+                          skipped_units: Dict[str, str]) -> None:
+    start_of_last_month, _ = billing_period
     msg = EmailMessage()
-    msg['Subject'] = f"Utility Bill Run Completed for {start_of_last_month.strftime('%b %Y')}"
+    msg['Subject'] = f"Utility Bill Run {'Needs Attention' if skipped_units else 'Completed'} for " \
+                     f"{start_of_last_month.strftime('%b %Y')}"
     msg['From'] = env.str("NOTIFICATION_SENDER")
     msg['To'] = (env.str("NOTIFICATION_EMAIL"),)
+    skipped = f"\n\nThese units were not billed because their meters could not be read: " \
+              f"{describe_skipped_units(skipped_units)}." if skipped_units else ""
     msg.set_content(dedent(f"""\
         Hi there,
         
         Utility bills have been generated and posted to PayHOA. Please verify that bills are accurate before they are published
-        on {invoice_date.strftime('%m/%d/%Y at %I:%M %p %Z').strip()}.
+        on {invoice_date.strftime('%m/%d/%Y at %I:%M %p %Z').strip()}.{skipped}
          
         View Invoices at https://app.payhoa.com/app/charges/organization/issued
         
@@ -137,7 +490,194 @@ def main():
         Auto-Bill"""))
     notify.email(msg)
     log.info("Notification Email Sent")
+
+
+def load_resident_emails(path: str) -> Dict[str, Dict[str, List[str]]]:
+    # {"<propertyId>": {"<unit>": "resident@example.com" or ["a@example.com", "b@example.com"]}, ...}
+    with open(path) as f:
+        return {property_id: {unit: [addresses] if isinstance(addresses, str) else list(addresses)
+                              for unit, addresses in units.items()}
+                for property_id, units in json.load(f).items()}
+
+
+def build_usage_email(sender: str, recipients: List[str], unit: str, gallons: float, charges: List[AssessedCharge],
+                      billing_period: Tuple[date, date], invoice_date: datetime) -> EmailMessage:
+    start_of_last_month, start_of_this_month = billing_period
+    breakdown = "\n".join(f"  {c.name} ({c.description})  ${c.amount:,.2f}" for c in charges)
+    msg = EmailMessage()
+    msg['Subject'] = f"Your Utility Bill for {start_of_last_month.strftime('%b %Y')} (Unit {unit})"
+    msg['From'] = sender
+    msg['To'] = recipients
+    msg.set_content(dedent("""\
+        Hi there,
+
+        Unit {unit} used {gallons:,.0f} gallons of water between {start} and {end}. Your utility bill is:
+
+        {breakdown}
+
+          Total  ${total:,.2f}
+
+        The invoice will be published in PayHOA on {published}.
+
+        Cheers,
+        Auto-Bill""").format(unit=unit, gallons=gallons, start=start_of_last_month.strftime('%m/%d/%Y'),
+                             end=start_of_this_month.strftime('%m/%d/%Y'), breakdown=breakdown,
+                             total=int(sum([c.amount for c in charges]) * 100) / 100,
+                             published=invoice_date.strftime('%m/%d/%Y at %I:%M %p %Z').strip()))
+    return msg
+
+
+def send_usage_emails(env: Env, billed: List[Tuple[BillingTarget, RunJournal, List[str]]],
+                      billing_period: Tuple[date, date], invoice_date: datetime) -> List[str]:
+    # Emails every invoiced unit of each (target, journal, invoiced units) its usage and charges over one pooled
+    # SMTP dispatcher. Units the journal already notified are skipped, so a rerun only retries failures.
+    resident_emails_path = env.str("RESIDENT_EMAILS", "")
+    if not resident_emails_path:
+        return []
+    resident_emails = load_resident_emails(resident_emails_path)
+
+    pending: Dict[str, Tuple[RunJournal, str]] = {}
+    with notify.NotificationDispatcher(notify.SmtpSettings.from_env(env),
+                                       env.int("SMTP_CONNECTIONS", notify.DEFAULT_SMTP_CONNECTIONS)) as dispatcher:
+        for target, journal, invoiced_units in billed:
+            recipients_by_unit = resident_emails.get(target.property_id, {})
+            if journal.usage is None:
+                log.warning(f"No usage recorded for property {target.property_id}, skipping resident emails")
+                continue
+
+            units, bills = calculate_unit_bills(journal.usage, journal.daily_usage, billing_period,
+                                                journal.meter_count)
+            for unit_index, unit in enumerate(units):
+                if unit not in invoiced_units or unit in journal.notified_units or not recipients_by_unit.get(unit):
+                    continue
+                reference = f"{target.property_id}/{unit}"
+                pending[reference] = (journal, unit)
+                dispatcher.send(build_usage_email(env.str("NOTIFICATION_SENDER"), recipients_by_unit[unit], unit,
+                                                  journal.usage[unit], bills.assessed_charges(unit_index),
+                                                  billing_period, invoice_date), reference)
+
+    failed: List[str] = []
+    for result in dispatcher.close():
+        journal, unit = pending[result.reference]
+        if result.succeeded:
+            journal.record_notified(unit)
+        else:
+            log.error(f"Usage email failed for {result.reference}: {result.error}")
+            failed.append(result.reference)
+    log.info(f"Sent {len(pending) - len(failed)} resident usage emails")
+    return failed
+
+
+def open_history(env: Env, property_id: Optional[str]) -> Tuple[ReadHistory, Dict[str, str]]:
+    # Returns the property's read history and the unit names last fetched for it, without logging in when a
+    # property id is given
+    cache_dir: Final[str] = env.str("CACHE_DIR", ".cache")
+    if property_id is None:
+        property_id = login_next_century(env, cache_dir).get_first_property_id()
+    unit_directory = UnitDirectory.load(os.path.join(cache_dir, "units", f"{property_id}.json"), math.inf)
+    names = {unit["_id"]: unit["name"] for unit in unit_directory.units} if unit_directory else {}
+    return ReadHistory.for_property(history_directory_for(env, cache_dir), property_id, ALL_WATER), names
+
+
+def backfill_history(env: Env, start: date, end: date, property_id: Optional[str] = None) -> None:
+    cache_dir: Final[str] = env.str("CACHE_DIR", ".cache")
+    next_century = login_next_century(env, cache_dir)
+    property_id = property_id or next_century.get_first_property_id()
+    with ReadHistory.for_property(history_directory_for(env, cache_dir), property_id, ALL_WATER) as history:
+        ingested = next_century.backfill_history(history, property_id, start, end)
+    log.info(f"Backfilled {len(ingested)} days of reads for property {property_id}")
+
+
+def print_usage_history(env: Env, start: date, end: date, property_id: Optional[str] = None) -> None:
+    history, names = open_history(env, property_id)
+    with history:
+        usage_by_unit = history.usage_by_unit(start, end)
+    for unit_id, usage in sorted(usage_by_unit.items(), key=lambda item: names.get(item[0], item[0])):
+        print(f"{names.get(unit_id, unit_id):<12} {usage:>12,.0f} gallons")
+
+
+def print_leak_candidates(env: Env, as_of: date, recent_days: int, baseline_days: int, factor: float,
+                          property_id: Optional[str] = None) -> None:
+    history, names = open_history(env, property_id)
+    with history:
+        candidates = history.leak_candidates(as_of, recent_days, baseline_days, factor)
+    for c in candidates:
+        print(f"{names.get(c.unit_id, c.unit_id):<12} {c.recent_daily_usage:>8,.1f} gallons/day over the last "
+              f"{recent_days} days, {c.baseline_daily_usage:,.1f} before ({c.ratio:,.1f}x)")
+
+
+def main(command: str = "run", plan_path: Optional[str] = None):
+    env = Env()
+    env.read_env()
+    try:
+        with METRICS.span("phase", phase="total"):
+            if command == "plan":
+                plan(env, plan_path)
+            elif command == "apply":
+                apply(env, plan_path)
+            else:
+                run(env)
+    finally:
+        write_metrics(env)
+
+
+def run(env: Env):
+    cache_dir: Final[str] = env.str("CACHE_DIR", ".cache")
+    start_of_last_month, start_of_this_month = billing_period = get_billing_period()
+    log.info(
+        f"Starting Bill Generation for Period {start_of_last_month.strftime('%m/%d/%Y')} - {start_of_this_month.strftime('%m/%d/%Y')}")
+    invoice_date: datetime = get_invoice_date()
+    stages = charge_pipeline(env, cache_dir, billing_period, invoice_date).run()
+    target, journal, charges = stages["target"], stages["journal"], stages["charges"]
+    result = submit_charges(stages["pay_hoa"], build_charge_request(target, list(charges.values()), billing_period),
+                            list(charges.keys()), target,
+                            env.int("PAY_HOA_CHARGE_CHUNK_SIZE", DEFAULT_CHARGE_CHUNK_SIZE), journal)
+    if result.failed_units:
+        raise RuntimeError(f"Failed to create invoices for {', '.join(result.failed_units)}")
+
+    send_completion_email(env, billing_period, invoice_date, result.skipped_units)
+    failed_emails = send_usage_emails(env, [(target, journal, result.invoiced_units)], billing_period, invoice_date)
+    if failed_emails:
+        raise RuntimeError(f"Failed to send usage emails for {', '.join(failed_emails)}")
     log.info("All Done! 🎉")
 
+
+def plan(env: Env, plan_path: str):
+    cache_dir: Final[str] = env.str("CACHE_DIR", ".cache")
+    start_of_last_month, start_of_this_month = billing_period = get_billing_period()
+    log.info(
+        f"Planning Bills for Period {start_of_last_month.strftime('%m/%d/%Y')} - {start_of_this_month.strftime('%m/%d/%Y')}")
+    invoice_date: datetime = get_invoice_date()
+    stages = charge_pipeline(env, cache_dir, billing_period, invoice_date).run()
+    target, journal, charges = stages["target"], stages["journal"], stages["charges"]
+    write_plan(plan_path, target.property_id, build_charge_request(target, list(charges.values()), billing_period),
+               list(charges.keys()), billing_period, invoice_date, journal.skipped_units)
+    log.info(f"Wrote {len(charges)} charges to {plan_path}")
+    if journal.skipped_units:
+        log.warning(f"Not billing {describe_skipped_units(journal.skipped_units)}")
+
+
+def apply(env: Env, plan_path: str):
+    cache_dir: Final[str] = env.str("CACHE_DIR", ".cache")
+    header, charge_request, units = read_plan(plan_path)
+    target = BillingTarget(header.property_id, header.organization_id)
+    pay_hoa = login_pay_hoa(env, target.organization_id, cache_dir)
+    log.info(f"Applying {len(units)} charges from {plan_path}")
+    journal = journal_for(env, target, header.billing_period)
+    result = submit_charges(pay_hoa, charge_request, units, target,
+                            env.int("PAY_HOA_CHARGE_CHUNK_SIZE", DEFAULT_CHARGE_CHUNK_SIZE), journal,
+                            header.skipped_units)
+    if result.failed_units:
+        raise RuntimeError(f"Failed to create invoices for {', '.join(result.failed_units)}")
+
+    send_completion_email(env, header.billing_period, header.invoice_date, result.skipped_units)
+    failed_emails = send_usage_emails(env, [(target, journal, result.invoiced_units)], header.billing_period,
+                                      header.invoice_date)
+    if failed_emails:
+        raise RuntimeError(f"Failed to send usage emails for {', '.join(failed_emails)}")
+    log.info("All Done! 🎉")
+
+
 if __name__ == '__main__':
-    main()
+    import cli
+    sys.exit(cli.main(sys.argv[1:] or ["run"]))
@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Final, Any, Callable, NamedTuple, Optional
+
+from requests import Session
+
+from files import atomic_write
+from metrics import METRICS
+
+# Properties, units and categories change rarely; after this long they are checked again
+METADATA_TTL: Final[float] = 24 * 60 * 60
+DEFAULT_MEMORY_ENTRIES: Final[int] = 128
+
+
+class CachedResponse(NamedTuple):
+    body: Any
+    fetched_at: float
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+
+class MetadataCache:
+    # Slow-changing API payloads kept on disk, one file per resource, behind a bounded in-memory LRU. Entries
+    # younger than the TTL are used as they are; older ones are revalidated with If-None-Match or
+    # If-Modified-Since when the server sent a validator, and fetched again in full otherwise. Without a
+    # directory the cache only lives as long as the process.
+    def __init__(self, directory: Optional[str] = None, ttl: float = METADATA_TTL,
+                 max_entries: int = DEFAULT_MEMORY_ENTRIES) -> None:
+        self.directory: Final[Optional[str]] = directory
+        self.ttl: Final[float] = ttl
+        self.__max_entries: Final[int] = max_entries
+        self.__entries: Final[OrderedDict] = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def __path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{hashlib.sha256(key.encode('utf-8')).hexdigest()}.json")
+
+    def __remember(self, key: str, entry: CachedResponse) -> None:
+        with self.__lock:
+            self.__entries[key] = entry
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.__max_entries:
+                self.__entries.popitem(last=False)
+
+    def __read(self, key: str) -> Optional[CachedResponse]:
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None:
+                self.__entries.move_to_end(key)
+                return entry
+        if self.directory is None:
+            return None
+
+        try:
+            with open(self.__path(key)) as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            # A corrupt entry only costs a fetch
+            return None
+        if saved.get("key") != key:
+            return None
+
+        entry = CachedResponse(saved["body"], saved["fetchedAt"], saved.get("etag"), saved.get("lastModified"))
+        self.__remember(key, entry)
+        return entry
+
+    def __write(self, key: str, entry: CachedResponse) -> None:
+        self.__remember(key, entry)
+        if self.directory is None:
+            return
+
+        with atomic_write(self.__path(key)) as f:
+            json.dump({"key": key, "fetchedAt": entry.fetched_at, "etag": entry.etag,
+                       "lastModified": entry.last_modified, "body": entry.body}, f, separators=(",", ":"))
+
+    def __is_fresh(self, entry: CachedResponse, ttl: Optional[float]) -> bool:
+        return time.time() - entry.fetched_at < (self.ttl if ttl is None else ttl)
+
+    def get_json(self, session: Session, url: str, params: Optional[dict] = None, scope: str = "",
+                 ttl: Optional[float] = None) -> Any:
+        # scope separates accounts that see different data at the same URL
+        key = f"{scope}|{url}|{json.dumps(params or {}, sort_keys=True)}"
+        entry = self.__read(key)
+        if entry is not None and self.__is_fresh(entry, ttl):
+            METRICS.increment("metadata_cache", outcome="hit")
+            return entry.body
+
+        headers = {}
+        if entry is not None and entry.etag is not None:
+            headers["If-None-Match"] = entry.etag
+        if entry is not None and entry.last_modified is not None:
+            headers["If-Modified-Since"] = entry.last_modified
+        response = session.get(url, params=params, headers=headers)
+        if response.status_code == 304 and entry is not None:
+            METRICS.increment("metadata_cache", outcome="revalidated")
+            self.__write(key, entry._replace(fetched_at=time.time()))
+            return entry.body
+
+        response.raise_for_status()
+        METRICS.increment("metadata_cache", outcome="miss")
+        entry = CachedResponse(response.json(), time.time(), response.headers.get("ETag"),
+                               response.headers.get("Last-Modified"))
+        self.__write(key, entry)
+        return entry.body
+
+    def get_or_load(self, key: str, load: Callable[[], Any], ttl: Optional[float] = None) -> Any:
+        # For resources assembled from several requests, such as paginated lists, which can only expire
+        entry = self.__read(key)
+        if entry is not None and self.__is_fresh(entry, ttl):
+            METRICS.increment("metadata_cache", outcome="hit")
+            return entry.body
+
+        METRICS.increment("metadata_cache", outcome="miss")
+        entry = CachedResponse(load(), time.time())
+        self.__write(key, entry)
+        return entry.body
@@ -0,0 +1,109 @@
+import json
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Final, Dict, Tuple, Iterator, List
+
+from files import atomic_write
+
+Labels = Tuple[Tuple[str, str], ...]
+
+PROMETHEUS_PREFIX: Final[str] = "bill_run_"
+
+
+def _labels(labels: Dict[str, object]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _prometheus_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    escaped = (k + '="' + v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+               for k, v in labels)
+    return "{" + ",".join(escaped) + "}"
+
+
+class Metrics:
+    def __init__(self) -> None:
+        self.__lock: Final[threading.Lock] = threading.Lock()
+        self.__counters: Dict[Tuple[str, Labels], float] = {}
+        # name, labels -> [count, total seconds, max seconds]
+        self.__timings: Dict[Tuple[str, Labels], List[float]] = {}
+
+    def increment(self, name: str, amount: float = 1, **labels) -> None:
+        key = (name, _labels(labels))
+        with self.__lock:
+            self.__counters[key] = self.__counters.get(key, 0) + amount
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        key = (name, _labels(labels))
+        with self.__lock:
+            timing = self.__timings.setdefault(key, [0, 0.0, 0.0])
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = max(timing[2], seconds)
+
+    @contextmanager
+    def span(self, name: str, **labels) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def reset(self) -> None:
+        with self.__lock:
+            self.__counters.clear()
+            self.__timings.clear()
+
+    def summary(self) -> dict:
+        with self.__lock:
+            return {
+                "counters": [{"name": name, "labels": dict(labels), "value": value}
+                             for (name, labels), value in sorted(self.__counters.items())],
+                "timings": [{"name": name, "labels": dict(labels), "count": int(count),
+                             "totalSeconds": round(total, 6), "maxSeconds": round(maximum, 6)}
+                            for (name, labels), (count, total, maximum) in sorted(self.__timings.items())],
+            }
+
+    def prometheus(self) -> str:
+        lines: List[str] = []
+        summary = self.summary()
+
+        for name in sorted({c["name"] for c in summary["counters"]}):
+            metric = PROMETHEUS_PREFIX + re.sub(r"[^a-zA-Z0-9_]", "_", name) + "_total"
+            lines.append(f"# TYPE {metric} counter")
+            for c in (c for c in summary["counters"] if c["name"] == name):
+                lines.append(f"{metric}{_prometheus_labels(_labels(c['labels']))} {c['value']}")
+
+        for name in sorted({t["name"] for t in summary["timings"]}):
+            metric = PROMETHEUS_PREFIX + re.sub(r"[^a-zA-Z0-9_]", "_", name) + "_seconds"
+            lines.append(f"# TYPE {metric} summary")
+            for t in (t for t in summary["timings"] if t["name"] == name):
+                labels = _prometheus_labels(_labels(t["labels"]))
+                lines.append(f"{metric}_sum{labels} {t['totalSeconds']}")
+                lines.append(f"{metric}_count{labels} {t['count']}")
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, json_path: str, prometheus_path: str) -> None:
+        for path, contents in ((json_path, json.dumps(self.summary(), indent=2)), (prometheus_path, self.prometheus())):
+            with atomic_write(path) as f:
+                f.write(contents)
+
+
+METRICS: Final[Metrics] = Metrics()
+
+
+def instrument_session(session, service: str) -> None:
+    def record_response(response, *args, **kwargs):
+        request = response.request
+        METRICS.increment("http_requests", service=service, method=request.method, status=response.status_code)
+        METRICS.observe("http_request", response.elapsed.total_seconds(), service=service, method=request.method)
+
+        # Streamed downloads are counted as they are read
+        if not kwargs.get("stream") and response.headers.get("Content-Length"):
+            METRICS.increment("http_response_bytes", int(response.headers["Content-Length"]), service=service)
+
+    session.hooks["response"].append(record_response)
@@ -1,82 +1,398 @@
+import codecs
 import json
+import random
+import re
 import time
-from datetime import date
-from functools import cache
-from typing import Final, List, Optional
+from datetime import date, timedelta
+from itertools import chain
+from http.cookiejar import CookieJar
+from typing import Final, List, Optional, Dict, Iterable, Iterator, Tuple, Container, Callable, TypeVar
 
 import requests as requests
+from requests import Session, PreparedRequest
+
+from credentials import CredentialStore, Credentials, SessionAuth, dump_cookies, load_cookies, token_expiry
+from metadata import MetadataCache
+from metrics import METRICS, instrument_session
+from next_century.history import ReadHistory
+from next_century.snapshots import SnapshotStore
+from next_century.units import UnitDirectory, UNIT_DIRECTORY_TTL
+from throttle import RATE_LIMITER, RateLimit, ThrottledAdapter
 
 base_url: Final[str] = "https://api.nextcenturymeters.com"
 
+T = TypeVar("T")
+
+# Read exports are polled with exponential backoff and full jitter until the deadline passes
+READ_POLL_INITIAL_DELAY: Final[float] = 0.5
+READ_POLL_MAX_DELAY: Final[float] = 10.0
+READ_POLL_DEADLINE: Final[float] = 300.0
+
+DEFAULT_POOL_SIZE: Final[int] = 10
+DEFAULT_RATE_LIMIT: Final[RateLimit] = RateLimit(rate=20.0, burst=DEFAULT_POOL_SIZE)
+
+ALL_WATER: Final[int] = 5
+READ_DOWNLOAD_CHUNK_SIZE: Final[int] = 64 * 1024
+# The day a read in a range export was taken, as an ISO 8601 date or timestamp
+READ_DATE_FIELD: Final[str] = "readDate"
+# Days exported at once when backfilling read history
+HISTORY_BACKFILL_BATCH_DAYS: Final[int] = 31
+
+# Characters that separate records in NDJSON or a JSON array
+_RECORD_SEPARATORS: Final[str] = " \t\r\n,[]"
+_READS_WRAPPER: Final[re.Pattern] = re.compile(r'\{\s*"reads"\s*:\s*\[')
+# A member of the wrapper object after its reads, up to the start of its value
+_WRAPPER_MEMBER: Final[re.Pattern] = re.compile(r'[\s,]*"(?:[^"\\]|\\.)*"\s*:\s*')
+_WRAPPER_END: Final[re.Pattern] = re.compile(r'[\s,]*\}')
+
+
+def iter_json_records(chunks: Iterable[str]) -> Iterator[dict]:
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    # After an incomplete record, wait for the buffer to double before decoding again so that a single
+    # large record is not re-scanned once per chunk
+    decode_at = 0
+    # Inside the reads array of a {"reads": [...]} wrapper, and then inside the rest of the wrapper
+    in_reads = in_wrapper = False
+
+    for chunk in chain(chunks, [None]):
+        if chunk is not None:
+            buffer = buffer[position:] + chunk
+            decode_at -= position
+            position = 0
+            if len(buffer) < decode_at:
+                continue
+
+        while True:
+            if in_wrapper and not in_reads:
+                # Members after the reads, such as a total, are read past and dropped
+                end = _WRAPPER_END.match(buffer, position)
+                if end:
+                    position, in_wrapper = end.end(), False
+                    continue
+                member = _WRAPPER_MEMBER.match(buffer, position)
+                try:
+                    if not member:
+                        raise json.JSONDecodeError("Expected a member of the reads wrapper", buffer, position)
+                    _, position_after = decoder.raw_decode(buffer, member.end())
+                except json.JSONDecodeError:
+                    if chunk is None:
+                        raise
+                    decode_at = len(buffer) * 2
+                    break
+                position = position_after
+                continue
+
+            while position < len(buffer) and buffer[position] in _RECORD_SEPARATORS:
+                if in_reads and buffer[position] == "]":
+                    in_reads = False
+                    position += 1
+                    break
+                position += 1
+            if in_wrapper and not in_reads:
+                continue
+            if position == len(buffer):
+                break
+
+            wrapper = _READS_WRAPPER.match(buffer, position)
+            if wrapper:
+                position = wrapper.end()
+                in_reads = in_wrapper = True
+                continue
+
+            try:
+                record, position_after = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if chunk is None:
+                    raise
+                decode_at = len(buffer) * 2
+                break
+
+            position = position_after
+            if not isinstance(record, dict):
+                raise ValueError(f"Unexpected read download payload type: {type(record).__name__}")
+            if isinstance(record.get("reads"), list):
+                yield from record["reads"]
+            else:
+                yield record
+
+
+class NextCenturyAuth(SessionAuth):
+    def __init__(self, cookies: CookieJar, login: Callable[[int], None], api_url: str = base_url) -> None:
+        super().__init__(api_url, cookies, login, "next_century")
+        self.auth_token: Optional[str] = None
+
+    def add_credentials(self, request: PreparedRequest) -> None:
+        if self.auth_token is not None:
+            request.headers["authorization"] = self.auth_token
+        request.headers["version"] = "2"
+
 
 class NextCentury:
-    def __init__(self, email: str, password: str) -> None:
-        login_response = requests.post(f"{base_url}/login", json={
-            "email": email,
-            "password": password
+    def __init__(self, email: str, password: str, pool_size: int = DEFAULT_POOL_SIZE,
+                 snapshot_store: Optional[SnapshotStore] = None, api_url: str = base_url,
+                 credential_store: Optional[CredentialStore] = None, history_directory: Optional[str] = None,
+                 rate_limit: RateLimit = DEFAULT_RATE_LIMIT, metadata_cache: Optional[MetadataCache] = None,
+                 read_deadline: float = READ_POLL_DEADLINE) -> None:
+        self.__base_url: Final[str] = api_url
+        self.__history_directory: Final[Optional[str]] = history_directory
+        # How long read exports are polled for when a call does not give its own deadline
+        self.__read_deadline: Final[float] = read_deadline
+        self.__email: Final[str] = email
+        self.__password: Final[str] = password
+        self.__snapshot_store: Final[Optional[SnapshotStore]] = snapshot_store
+        self.__credential_store: Final[Optional[CredentialStore]] = credential_store
+        self.__unit_directories: Final[Dict[str, UnitDirectory]] = {}
+        self.__metadata_cache: Final[MetadataCache] = metadata_cache or MetadataCache()
+        self.__session: Session = requests.sessions.Session()
+        # Only idempotent GETs are retried on server errors; login is a POST and should fail loudly
+        RATE_LIMITER.configure(api_url, rate_limit)
+        adapter = ThrottledAdapter("next_century", pool_connections=pool_size, pool_maxsize=pool_size)
+        self.__session.mount("https://", adapter)
+        self.__session.mount("http://", adapter)
+        self.__session.headers["Connection"] = "keep-alive"
+        instrument_session(self.__session, "next_century")
+
+        # Read downloads are pre-signed URLs on another host, which reject a second set of credentials, so
+        # the token is only sent to the API. An expired token is replaced by logging in again.
+        self.__auth: Final[NextCenturyAuth] = NextCenturyAuth(self.__session.cookies, self.__login, self.__base_url)
+        self.__session.auth = self.__auth
+
+        credentials = credential_store.get(api_url, email) if credential_store is not None else None
+        if credentials is None:
+            self.__auth.authenticate()
+        else:
+            self.__auth.auth_token = credentials.token
+            load_cookies(self.__session.cookies, credentials.cookies)
+
+    def __login(self, status_code: int) -> None:
+        login_response = self.__session.post(f"{self.__base_url}/login", json={
+            "email": self.__email,
+            "password": self.__password
         })
 
         login_response.raise_for_status()
-        self.__auth_token = login_response.json()["token"]
+        self.__auth.auth_token = login_response.json()["token"]
+        if self.__credential_store is not None:
+            self.__credential_store.put(self.__base_url, self.__email, Credentials(
+                self.__auth.auth_token, dump_cookies(self.__session.cookies), token_expiry(self.__auth.auth_token)))
 
     def get_first_property_id(self) -> str:
-        response = requests.get(f"{base_url}/api/Properties", headers={
-            "authorization": self.__auth_token,
-            "version": "2",
-        })
-        response.raise_for_status()
+        properties = self.__metadata_cache.get_json(self.__session, f"{self.__base_url}/api/Properties",
+                                                    scope=self.__email)
+        return properties[0]["_id"]
+
+    def prepare_read_download(self, property_id: str, for_date: date, end: Optional[date] = None) -> Optional[str]:
+        # With an end date, a single export covers every day from for_date through end
+        params = {"start": for_date.strftime("%Y-%m-%d")}
+        if end is not None:
+            params["end"] = end.strftime("%Y-%m-%d")
+        prepare_response = self.__session.get(f"{self.__base_url}/api/Properties/{property_id}/PrepareReadDownload",
+                                              params=params)
+
+        prepare_response.raise_for_status()
+        response_json: dict = prepare_response.json()
+        if response_json.get("state") == "COMPLETE":
+            return response_json.get("url")
 
-        return response.json()[0]["_id"]
-
-    def get_daily_read_for_property(self, property_id: str, for_date: date) -> List[dict]:
-        download_url: Optional[str] = None
-        while download_url is None:
-            prepare_response = requests.get(f"{base_url}/api/Properties/{property_id}/PrepareReadDownload", params={
-                "start": for_date.strftime("%Y-%m-%d")
-            }, headers={
-                "authorization": self.__auth_token,
-                "version": "2",
-            })
-
-            prepare_response.raise_for_status()
-            response_json: dict = prepare_response.json()
-            if response_json.get("state") == "COMPLETE":
-                download_url = response_json.get("url")
+        return None
+
+    def __poll_exports(self, pending: List[T], prepare: Callable[[T], Optional[str]], deadline: Optional[float],
+                       describe: Callable[[T], str]) -> Dict[T, str]:
+        download_urls: Dict[T, str] = {}
+        deadline = self.__read_deadline if deadline is None else deadline
+        give_up_at = time.monotonic() + deadline
+        delay = READ_POLL_INITIAL_DELAY
+
+        # Every pass re-requests each outstanding export, so all of the jobs are prepared side by side
+        # and the run waits roughly as long as the slowest one instead of the sum of all of them.
+        while True:
+            METRICS.increment("next_century_poll_iterations")
+            for job in list(pending):
+                download_url = prepare(job)
+                if download_url is not None:
+                    download_urls[job] = download_url
+                    pending.remove(job)
+
+            if not pending:
+                return download_urls
+
+            remaining = give_up_at - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(
+                    f"Read downloads for {', '.join(describe(job) for job in pending)} "
+                    f"were not ready after {deadline:.0f}s")
+
+            time.sleep(min(random.uniform(0, delay), remaining))
+            delay = min(delay * 2, READ_POLL_MAX_DELAY)
+
+    def prepare_read_downloads(self, property_id: str, for_dates: Iterable[date],
+                               deadline: Optional[float] = None) -> Dict[date, str]:
+        return self.__poll_exports(list(dict.fromkeys(for_dates)),
+                                   lambda for_date: self.prepare_read_download(property_id, for_date), deadline,
+                                   lambda for_date: for_date.strftime('%m/%d/%Y'))
+
+    def prepare_range_download(self, property_id: str, start: date, end: date,
+                               deadline: Optional[float] = None) -> str:
+        return self.__poll_exports([(start, end)],
+                                   lambda job: self.prepare_read_download(property_id, *job), deadline,
+                                   lambda job: f"{job[0].strftime('%m/%d/%Y')} - {job[1].strftime('%m/%d/%Y')}"
+                                   )[(start, end)]
+
+    def __iter_download_text(self, download_url: str) -> Iterator[str]:
+        with self.__session.get(download_url, stream=True) as report_response:
+            report_response.raise_for_status()
+            decoder = codecs.getincrementaldecoder("utf-8-sig")()
+            for chunk in report_response.iter_content(READ_DOWNLOAD_CHUNK_SIZE):
+                METRICS.increment("http_response_bytes", len(chunk), service="next_century")
+                yield decoder.decode(chunk)
+            yield decoder.decode(b"", final=True)
+
+    def download_reads(self, download_url: str) -> List[dict]:
+        return list(iter_json_records(self.__iter_download_text(download_url)))
+
+    def __iter_meter_reads(self, download_url: str, utility_type_id: int,
+                           unit_ids: Optional[Container[str]]) -> Iterator[Tuple[str, dict]]:
+        for record in iter_json_records(self.__iter_download_text(download_url)):
+            meter_read: dict = record.get("meterRead") or {}
+            if meter_read.get("utilityTypeId") != utility_type_id:
+                continue
+            if unit_ids is not None and record.get("unitId") not in unit_ids:
+                continue
+            yield record["unitId"], meter_read
+
+    def iter_reads(self, download_url: str, utility_type_id: int = ALL_WATER,
+                   unit_ids: Optional[Container[str]] = None) -> Iterator[Tuple[str, int]]:
+        for unit_id, meter_read in self.__iter_meter_reads(download_url, utility_type_id, unit_ids):
+            yield unit_id, meter_read["computed"]
+
+    def iter_dated_reads(self, download_url: str, utility_type_id: int = ALL_WATER,
+                         unit_ids: Optional[Container[str]] = None) -> Iterator[Tuple[date, str, int]]:
+        # Range exports hold one read per unit per day, told apart by the day each read was taken. A read
+        # without a date cannot be placed, so it is left out and the missing days fall back to daily exports.
+        for unit_id, meter_read in self.__iter_meter_reads(download_url, utility_type_id, unit_ids):
+            read_date = meter_read.get(READ_DATE_FIELD)
+            if read_date:
+                yield date.fromisoformat(read_date[:10]), unit_id, meter_read["computed"]
+
+    def get_daily_reads_for_property(self, property_id: str, for_dates: Iterable[date],
+                                     deadline: Optional[float] = None) -> Dict[date, List[dict]]:
+        download_urls = self.prepare_read_downloads(property_id, for_dates, deadline)
+        return {for_date: self.download_reads(download_url) for for_date, download_url in download_urls.items()}
+
+    def __keep_final_reads(self, property_id: str, utility_type_id: int,
+                           reads_by_date: Dict[date, Dict[str, int]]) -> None:
+        # A day's reads are only final once the day is over
+        final = {for_date: reads for for_date, reads in reads_by_date.items() if reads and for_date < date.today()}
+        if self.__snapshot_store:
+            for for_date, reads in final.items():
+                self.__snapshot_store.put(property_id, for_date, utility_type_id, reads)
+        if self.__history_directory and final:
+            with ReadHistory.for_property(self.__history_directory, property_id, utility_type_id) as history:
+                for for_date in sorted(final):
+                    history.ingest(for_date, final[for_date])
+
+    def get_reads_by_unit(self, property_id: str, for_dates: Iterable[date], utility_type_id: int = ALL_WATER,
+                          unit_ids: Optional[Container[str]] = None,
+                          deadline: Optional[float] = None) -> Dict[date, Dict[str, int]]:
+        reads_by_date: Dict[date, Dict[str, int]] = {}
+        missing_dates: List[date] = []
+        for for_date in dict.fromkeys(for_dates):
+            snapshot = self.__snapshot_store.get(property_id, for_date, utility_type_id) \
+                if self.__snapshot_store else None
+            if snapshot is None:
+                missing_dates.append(for_date)
             else:
-                time.sleep(2.5)
+                reads_by_date[for_date] = snapshot
 
-        report_response = requests.get(download_url)
-        report_response.raise_for_status()
+        METRICS.increment("next_century_snapshot_hits", len(reads_by_date))
+        if missing_dates:
+            with METRICS.span("phase", phase="read_export"):
+                download_urls = self.prepare_read_downloads(property_id, missing_dates, deadline)
+            downloaded: Dict[date, Dict[str, int]] = {}
+            for for_date, download_url in download_urls.items():
+                with METRICS.span("phase", phase="read_download"):
+                    downloaded[for_date] = dict(self.iter_reads(download_url, utility_type_id))
+            self.__keep_final_reads(property_id, utility_type_id, downloaded)
+            reads_by_date.update(downloaded)
 
-        try:
-            report_json = report_response.json()
-        except json.JSONDecodeError:
-            return [json.loads(line) for line in report_response.text.splitlines() if line.strip()]
+        if unit_ids is None:
+            return reads_by_date
 
-        if isinstance(report_json, list):
-            return report_json
+        return {for_date: {unit_id: computed for unit_id, computed in reads.items() if unit_id in unit_ids}
+                for for_date, reads in reads_by_date.items()}
 
-        if isinstance(report_json, dict):
-            if isinstance(report_json.get("reads"), list):
-                return report_json["reads"]
-            return [report_json]
+    def get_reads_for_range(self, property_id: str, start: date, end: date, utility_type_id: int = ALL_WATER,
+                            deadline: Optional[float] = None) -> Dict[date, Dict[str, int]]:
+        # Every day's reads from start through end. Unless all of them are cached, this takes one export job
+        # rather than one per day.
+        days = [start + timedelta(days=n) for n in range((end - start).days + 1)]
+        reads_by_date: Dict[date, Dict[str, int]] = {}
+        for for_date in days:
+            snapshot = self.__snapshot_store.get(property_id, for_date, utility_type_id) \
+                if self.__snapshot_store else None
+            if snapshot is not None:
+                reads_by_date[for_date] = snapshot
 
-        raise ValueError(f"Unexpected read download payload type: {type(report_json).__name__}")
+        METRICS.increment("next_century_snapshot_hits", len(reads_by_date))
+        if len(reads_by_date) == len(days):
+            return reads_by_date
 
-    @cache
-    def list_units(self, property_id: str):
-        response = requests.get(f"{base_url}/api/Properties/{property_id}/Units", headers={
-            "authorization": self.__auth_token,
-            "version": "2",
-        })
+        with METRICS.span("phase", phase="read_export"):
+            download_url = self.prepare_range_download(property_id, start, end, deadline)
+        downloaded: Dict[date, Dict[str, int]] = {}
+        with METRICS.span("phase", phase="read_download"):
+            for for_date, unit_id, computed in self.iter_dated_reads(download_url, utility_type_id):
+                downloaded.setdefault(for_date, {})[unit_id] = computed
+        self.__keep_final_reads(property_id, utility_type_id,
+                                {d: reads for d, reads in downloaded.items() if d not in reads_by_date})
+        return {**downloaded, **reads_by_date}
+
+    def backfill_history(self, history: ReadHistory, property_id: str, start: date, end: date,
+                         utility_type_id: int = ALL_WATER, batch_days: int = HISTORY_BACKFILL_BATCH_DAYS,
+                         deadline: Optional[float] = None) -> List[date]:
+        # Only days the history has no reads for are exported, a batch at a time so an interrupted backfill
+        # keeps what it already downloaded and the next one picks up where it stopped
+        missing_dates = [d for d in history.missing_dates(start, end) if d < date.today()]
+        ingested: List[date] = []
+        for offset in range(0, len(missing_dates), batch_days):
+            with METRICS.span("phase", phase="read_export"):
+                download_urls = self.prepare_read_downloads(property_id, missing_dates[offset:offset + batch_days],
+                                                            deadline)
+            for for_date in sorted(download_urls):
+                with METRICS.span("phase", phase="read_download"):
+                    history.ingest(for_date, dict(self.iter_reads(download_urls[for_date], utility_type_id)))
+                ingested.append(for_date)
+            history.flush()
+        return ingested
+
+    def get_daily_read_for_property(self, property_id: str, for_date: date,
+                                    deadline: Optional[float] = None) -> List[dict]:
+        return self.get_daily_reads_for_property(property_id, [for_date], deadline)[for_date]
+
+    def list_units(self, property_id: str) -> List[dict]:
+        # Not kept in the metadata cache; get_unit_directory saves the units it builds on its own
+        response = self.__session.get(f"{self.__base_url}/api/Properties/{property_id}/Units")
 
         response.raise_for_status()
 
         return response.json()
 
-    def get_unit(self, property_id: str, unit_id: str) -> Optional[dict]:
-        for unit in self.list_units(property_id):
-            if unit['_id'] == unit_id:
-                return unit
+    def get_unit_directory(self, property_id: str, cache_path: Optional[str] = None,
+                           ttl: float = UNIT_DIRECTORY_TTL) -> UnitDirectory:
+        directory = self.__unit_directories.get(property_id)
+        if directory is not None and directory.is_fresh(ttl):
+            return directory
 
-        return None
+        directory = UnitDirectory.load(cache_path, ttl) if cache_path else None
+        if directory is None:
+            directory = UnitDirectory(self.list_units(property_id))
+            if cache_path:
+                directory.save(cache_path)
+
+        self.__unit_directories[property_id] = directory
+        return directory
+
+    def get_unit(self, property_id: str, unit_id: str) -> Optional[dict]:
+        return self.get_unit_directory(property_id).get(unit_id)
@@ -0,0 +1,118 @@
+import math
+from array import array
+from enum import IntFlag
+from typing import Final, Dict, Iterator, List, Mapping, Tuple
+
+from numeric import optional_numpy
+
+# A read that went down is taken as the register wrapping past zero when the start read was in the top tenth of its
+# register and the wrapped usage is under a tenth of it; anything else that went down is a replaced or faulty meter
+ROLLOVER_WINDOW: Final[float] = 0.1
+
+_MISSING: Final[float] = float("nan")
+
+
+class ReadFlag(IntFlag):
+    OK = 0
+    MISSING_START = 1
+    MISSING_END = 2
+    NEGATIVE = 4
+    ROLLOVER = 8
+
+
+# Flags that leave a unit without a usage figure
+UNUSABLE: Final[ReadFlag] = ReadFlag.MISSING_START | ReadFlag.MISSING_END | ReadFlag.NEGATIVE
+
+
+def register_capacity(read: float) -> float:
+    # The smallest power of ten above the read, i.e. where a register with that many digits wraps
+    return 10.0 ** (math.floor(math.log10(read)) + 1) if read >= 1 else 10.0
+
+
+class SnapshotDiff:
+    # Usage between two snapshots of cumulative reads, one slot per unit. Unit ids are interned to ordinals in
+    # the order they were first seen, and usage and flags are typed arrays indexed by ordinal; usage is NaN for
+    # any unit flagged as unusable.
+    def __init__(self, unit_ids: List[str], usage: array, flags: array) -> None:
+        self.unit_ids: Final[List[str]] = unit_ids
+        self.usage: Final[array] = usage
+        self.flags: Final[array] = flags
+
+    def __len__(self) -> int:
+        return len(self.unit_ids)
+
+    def flag_of(self, ordinal: int) -> ReadFlag:
+        return ReadFlag(self.flags[ordinal])
+
+    def usage_by_unit(self) -> Dict[str, float]:
+        return {unit_id: self.usage[ordinal] for ordinal, unit_id in enumerate(self.unit_ids)
+                if not self.flags[ordinal] & UNUSABLE}
+
+    def flagged(self) -> Iterator[Tuple[str, ReadFlag]]:
+        for ordinal, unit_id in enumerate(self.unit_ids):
+            if self.flags[ordinal]:
+                yield unit_id, ReadFlag(self.flags[ordinal])
+
+
+def diff_snapshots(start: Mapping[str, float], end: Mapping[str, float]) -> SnapshotDiff:
+    ordinals: Dict[str, int] = {}
+    for unit_id in end:
+        ordinals.setdefault(unit_id, len(ordinals))
+    for unit_id in start:
+        ordinals.setdefault(unit_id, len(ordinals))
+
+    start_reads = array("d", [_MISSING]) * len(ordinals)
+    end_reads = array("d", [_MISSING]) * len(ordinals)
+    for unit_id, read in start.items():
+        start_reads[ordinals[unit_id]] = read
+    for unit_id, read in end.items():
+        end_reads[ordinals[unit_id]] = read
+
+    numpy = optional_numpy()
+    if numpy is not None:
+        usage, flags = _diff_numpy(numpy, start_reads, end_reads)
+    else:
+        usage, flags = _diff_python(start_reads, end_reads)
+    return SnapshotDiff(list(ordinals), usage, flags)
+
+
+def _diff_numpy(numpy, start_reads: array, end_reads: array) -> Tuple[array, array]:
+    start = numpy.frombuffer(start_reads, dtype=numpy.float64)
+    end = numpy.frombuffer(end_reads, dtype=numpy.float64)
+    usage = end - start
+    missing_start, missing_end = numpy.isnan(start), numpy.isnan(end)
+    went_down = usage < 0
+
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        capacity = numpy.where(start >= 1, 10.0 ** (numpy.floor(numpy.log10(start)) + 1), 10.0)
+    wrapped = capacity - start + end
+    rollover = went_down & (start >= capacity * (1 - ROLLOVER_WINDOW)) & (wrapped < capacity * ROLLOVER_WINDOW)
+    negative = went_down & ~rollover
+
+    flags = (missing_start * int(ReadFlag.MISSING_START) + missing_end * int(ReadFlag.MISSING_END)
+             + negative * int(ReadFlag.NEGATIVE) + rollover * int(ReadFlag.ROLLOVER)).astype(numpy.uint8)
+    usage = numpy.where(rollover, wrapped, usage)
+    usage[negative] = _MISSING
+    return array("d", usage.tobytes()), array("B", flags.tobytes())
+
+
+def _diff_python(start_reads: array, end_reads: array) -> Tuple[array, array]:
+    usage = array("d", end_reads)
+    flags = array("B", bytes(len(start_reads)))
+    for ordinal, (start, end) in enumerate(zip(start_reads, end_reads)):
+        flag = ReadFlag.OK
+        if math.isnan(start):
+            flag |= ReadFlag.MISSING_START
+        if math.isnan(end):
+            flag |= ReadFlag.MISSING_END
+        if not flag and end < start:
+            capacity = register_capacity(start)
+            wrapped = capacity - start + end
+            if start >= capacity * (1 - ROLLOVER_WINDOW) and wrapped < capacity * ROLLOVER_WINDOW:
+                flag, usage[ordinal] = ReadFlag.ROLLOVER, wrapped
+            else:
+                flag, usage[ordinal] = ReadFlag.NEGATIVE, _MISSING
+        else:
+            usage[ordinal] = end - start
+        flags[ordinal] = flag
+    return usage, flags
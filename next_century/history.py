@@ -0,0 +1,234 @@
+import json
+import math
+import mmap
+import os
+import struct
+from array import array
+from datetime import date, timedelta
+from typing import Final, Dict, List, Mapping, NamedTuple, Optional
+
+from files import atomic_write
+
+HISTORY_MAGIC: Final[bytes] = b"NCH1"
+INITIAL_CAPACITY_DAYS: Final[int] = 366
+
+# magic | first day (proleptic ordinal) | days per unit | units
+_HEADER: Final[struct.Struct] = struct.Struct("<4siii")
+_MISSING: Final[float] = float("nan")
+_MISSING_BYTES: Final[bytes] = struct.pack("<d", _MISSING)
+
+
+class LeakCandidate(NamedTuple):
+    unit_id: str
+    recent_daily_usage: float
+    baseline_daily_usage: float
+
+    @property
+    def ratio(self) -> float:
+        return self.recent_daily_usage / self.baseline_daily_usage if self.baseline_daily_usage else math.inf
+
+
+def _value(x: float) -> Optional[float]:
+    return None if math.isnan(x) else x
+
+
+class ReadHistory:
+    # Daily meter reads for one property and utility, stored column by column: every unit owns a block of
+    # `capacity` float64 reads, one per day starting at `epoch`, with NaN for days without a read. The file is
+    # memory-mapped, so a unit's history is one contiguous slice and a usage figure is two lookups because
+    # reads are cumulative. Unit ids live next to it in a JSON list; only the first `units` of them are valid.
+    def __init__(self, path: str) -> None:
+        self.path: Final[str] = path
+        self.__units_path: Final[str] = f"{path}.units.json"
+        self.__units: List[str] = []
+        self.__slots: Dict[str, int] = {}
+        self.__epoch: Optional[int] = None
+        self.__capacity = 0
+        self.__file = None
+        self.__mmap: Optional[mmap.mmap] = None
+        self.__values: Optional[memoryview] = None
+
+        if os.path.exists(path):
+            self.__open()
+
+    @staticmethod
+    def for_property(directory: str, property_id: str, utility_type_id: int) -> 'ReadHistory':
+        return ReadHistory(os.path.join(directory, f"{property_id}.{utility_type_id}.reads"))
+
+    def __enter__(self) -> 'ReadHistory':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def flush(self) -> None:
+        # Reads can always be fetched again, so ingesting leaves write-back to the OS until asked
+        if self.__mmap is not None:
+            self.__mmap.flush()
+
+    def close(self) -> None:
+        self.flush()
+        if self.__values is not None:
+            self.__values.release()
+            self.__values = None
+        if self.__mmap is not None:
+            self.__mmap.close()
+            self.__mmap = None
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+
+    def __open(self) -> None:
+        self.close()
+        self.__file = open(self.path, "r+b")
+        self.__mmap = mmap.mmap(self.__file.fileno(), 0)
+        magic, epoch, capacity, unit_count = _HEADER.unpack_from(self.__mmap)
+        if magic != HISTORY_MAGIC:
+            raise ValueError(f"{self.path} is not a read history")
+
+        with open(self.__units_path) as f:
+            self.__units = json.load(f)[:unit_count]
+        self.__slots = {unit_id: slot for slot, unit_id in enumerate(self.__units)}
+        self.__epoch, self.__capacity = epoch, capacity
+        self.__values = memoryview(self.__mmap)[_HEADER.size:_HEADER.size + unit_count * capacity * 8].cast("d")
+
+    def __write_units(self, units: List[str]) -> None:
+        with atomic_write(self.__units_path) as f:
+            json.dump(units, f, separators=(",", ":"))
+
+    def __relayout(self, epoch: int, capacity: int, units: List[str]) -> None:
+        # Rewrites every block when the day range grows; the unit list is written first because the header's
+        # unit count is what makes new units visible
+        self.__write_units(units)
+
+        shift = (self.__epoch - epoch) if self.__epoch is not None else 0
+        with atomic_write(self.path, "wb") as f:
+            f.write(_HEADER.pack(HISTORY_MAGIC, epoch, capacity, len(units)))
+            for slot in range(len(units)):
+                block = array("d", [_MISSING]) * capacity
+                if slot < len(self.__units):
+                    with self.__values[slot * self.__capacity:(slot + 1) * self.__capacity] as old:
+                        block[shift:shift + self.__capacity] = array("d", old)
+                f.write(block.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+            self.close()
+        self.__open()
+
+    def __add_units(self, new_units: List[str]) -> None:
+        units = self.__units + new_units
+        self.__write_units(units)
+        self.close()
+        with open(self.path, "r+b") as f:
+            # Blocks past the old unit count may hold a torn write from an earlier crash, so overwrite them
+            f.seek(_HEADER.size + len(self.__units) * self.__capacity * 8)
+            f.write(_MISSING_BYTES * (self.__capacity * len(new_units)))
+            f.truncate()
+            f.flush()
+            os.fsync(f.fileno())
+            f.seek(0)
+            f.write(_HEADER.pack(HISTORY_MAGIC, self.__epoch, self.__capacity, len(units)))
+        self.__open()
+
+    @property
+    def units(self) -> List[str]:
+        return list(self.__units)
+
+    def __day(self, for_date: date) -> Optional[int]:
+        day = for_date.toordinal() - self.__epoch if self.__epoch is not None else -1
+        return day if 0 <= day < self.__capacity else None
+
+    def __at(self, slot: int, for_date: date) -> float:
+        day = self.__day(for_date)
+        return self.__values[slot * self.__capacity + day] if day is not None else _MISSING
+
+    def ingest(self, for_date: date, reads: Mapping[str, float]) -> None:
+        if not reads:
+            return
+
+        ordinal = for_date.toordinal()
+        if self.__epoch is None:
+            self.__relayout(ordinal, INITIAL_CAPACITY_DAYS, list(reads))
+        elif not self.__epoch <= ordinal < self.__epoch + self.__capacity:
+            # Grow by at least doubling so a day-by-day backfill rewrites the file a logarithmic number of times
+            epoch = min(self.__epoch, ordinal)
+            end = max(self.__epoch + self.__capacity, ordinal + 1)
+            capacity = max(end - epoch, self.__capacity * 2)
+            if ordinal < self.__epoch:
+                epoch = end - capacity
+            self.__relayout(epoch, capacity, self.__units + [u for u in reads if u not in self.__slots])
+        else:
+            new_units = [unit_id for unit_id in reads if unit_id not in self.__slots]
+            if new_units:
+                self.__add_units(new_units)
+
+        day = ordinal - self.__epoch
+        for unit_id, read in reads.items():
+            self.__values[self.__slots[unit_id] * self.__capacity + day] = float(read)
+
+    def has_reads(self, for_date: date) -> bool:
+        day = self.__day(for_date)
+        return day is not None and any(not math.isnan(self.__values[slot * self.__capacity + day])
+                                       for slot in range(len(self.__units)))
+
+    def missing_dates(self, start: date, end: date) -> List[date]:
+        return [start + timedelta(days=n) for n in range((end - start).days + 1)
+                if not self.has_reads(start + timedelta(days=n))]
+
+    def read(self, unit_id: str, for_date: date) -> Optional[float]:
+        slot = self.__slots.get(unit_id)
+        return _value(self.__at(slot, for_date)) if slot is not None else None
+
+    def reads(self, unit_id: str, start: date, end: date) -> List[Optional[float]]:
+        # One read per day from start to end inclusive
+        slot = self.__slots.get(unit_id)
+        days = (end - start).days + 1
+        if slot is None or self.__epoch is None:
+            return [None] * days
+
+        first = start.toordinal() - self.__epoch
+        lo, hi = max(first, 0), min(first + days, self.__capacity)
+        values = self.__values[slot * self.__capacity + lo:slot * self.__capacity + hi].tolist() if lo < hi else []
+        return [None] * (lo - first) + [_value(v) for v in values] + [None] * (days - (lo - first) - len(values))
+
+    def usage(self, unit_id: str, start: date, end: date) -> Optional[float]:
+        slot = self.__slots.get(unit_id)
+        return _value(self.__at(slot, end) - self.__at(slot, start)) if slot is not None else None
+
+    def usage_by_unit(self, start: date, end: date) -> Dict[str, float]:
+        usage_by_unit: Dict[str, float] = {}
+        for slot, unit_id in enumerate(self.__units):
+            usage = self.__at(slot, end) - self.__at(slot, start)
+            if not math.isnan(usage):
+                usage_by_unit[unit_id] = usage
+        return usage_by_unit
+
+    def daily_usage(self, unit_id: str, start: date, end: date) -> List[Optional[float]]:
+        # Usage on each day from start up to, but not including, end
+        reads = self.reads(unit_id, start, end)
+        return [b - a if a is not None and b is not None else None for a, b in zip(reads, reads[1:])]
+
+    def rolling_average(self, unit_id: str, start: date, end: date, window_days: int) -> List[Optional[float]]:
+        # Average daily usage over the window_days ending on each day from start to end inclusive
+        reads = self.reads(unit_id, start - timedelta(days=window_days), end)
+        return [(b - a) / window_days if a is not None and b is not None else None
+                for a, b in zip(reads, reads[window_days:])]
+
+    def leak_candidates(self, as_of: date, recent_days: int = 7, baseline_days: int = 90,
+                        factor: float = 3.0) -> List[LeakCandidate]:
+        # Units whose average daily usage over the last recent_days is at least factor times their average over
+        # the baseline_days before that
+        recent_start = as_of - timedelta(days=recent_days)
+        baseline_start = recent_start - timedelta(days=baseline_days)
+        candidates: List[LeakCandidate] = []
+        for slot, unit_id in enumerate(self.__units):
+            recent_read, as_of_read = self.__at(slot, recent_start), self.__at(slot, as_of)
+            baseline_read = self.__at(slot, baseline_start)
+            recent = (as_of_read - recent_read) / recent_days
+            baseline = (recent_read - baseline_read) / baseline_days
+            if math.isnan(recent) or math.isnan(baseline) or recent <= 0:
+                continue
+            if recent >= baseline * factor:
+                candidates.append(LeakCandidate(unit_id, recent, baseline))
+
+        return sorted(candidates, key=lambda c: c.ratio, reverse=True)
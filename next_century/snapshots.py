@@ -0,0 +1,66 @@
+import hashlib
+import json
+import os
+import zlib
+from datetime import date
+from typing import Final, Dict, Optional, List, Tuple
+
+from files import atomic_write
+
+SNAPSHOT_MAGIC: Final[bytes] = b"NCS1"
+DEFAULT_MAX_BYTES: Final[int] = 64 * 1024 * 1024
+
+
+class SnapshotStore:
+    # Each snapshot is stored as MAGIC | sha256(body) | body, where body is a zlib-compressed
+    # JSON object of unitId -> computed read. A snapshot that fails its checksum is discarded.
+    def __init__(self, directory: str, max_bytes: int = DEFAULT_MAX_BYTES) -> None:
+        self.__directory: Final[str] = directory
+        self.__max_bytes: Final[int] = max_bytes
+
+    def __path(self, property_id: str, for_date: date, utility_type_id: int) -> str:
+        return os.path.join(self.__directory, property_id, f"{for_date.isoformat()}.{utility_type_id}.snap")
+
+    def get(self, property_id: str, for_date: date, utility_type_id: int) -> Optional[Dict[str, int]]:
+        path = self.__path(property_id, for_date, utility_type_id)
+        try:
+            with open(path, "rb") as f:
+                contents = f.read()
+        except FileNotFoundError:
+            return None
+
+        digest_end = len(SNAPSHOT_MAGIC) + hashlib.sha256().digest_size
+        body = contents[digest_end:]
+        if contents[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC or \
+                hashlib.sha256(body).digest() != contents[len(SNAPSHOT_MAGIC):digest_end]:
+            os.remove(path)
+            return None
+
+        # Touch the snapshot so eviction removes the least recently used ones first
+        os.utime(path)
+        return json.loads(zlib.decompress(body))
+
+    def put(self, property_id: str, for_date: date, utility_type_id: int, reads: Dict[str, int]) -> None:
+        path = self.__path(property_id, for_date, utility_type_id)
+        body = zlib.compress(json.dumps(reads, separators=(",", ":")).encode("utf-8"), 9)
+        with atomic_write(path, "wb") as f:
+            f.write(SNAPSHOT_MAGIC)
+            f.write(hashlib.sha256(body).digest())
+            f.write(body)
+
+        self.__evict()
+
+    def __evict(self) -> None:
+        snapshots: List[Tuple[float, int, str]] = []
+        for directory, _, files in os.walk(self.__directory):
+            for name in files:
+                if name.endswith(".snap"):
+                    stat = os.stat(os.path.join(directory, name))
+                    snapshots.append((stat.st_mtime, stat.st_size, os.path.join(directory, name)))
+
+        total_bytes = sum(size for _, size, _ in snapshots)
+        for _, size, path in sorted(snapshots):
+            if total_bytes <= self.__max_bytes:
+                break
+            os.remove(path)
+            total_bytes -= size
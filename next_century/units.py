@@ -0,0 +1,45 @@
+import json
+import time
+from typing import Final, Dict, List, Optional
+
+from files import atomic_write
+
+UNIT_DIRECTORY_TTL: Final[float] = 24 * 60 * 60
+
+
+class UnitDirectory:
+    def __init__(self, units: List[dict], fetched_at: Optional[float] = None) -> None:
+        self.units: Final[List[dict]] = units
+        self.fetched_at: Final[float] = time.time() if fetched_at is None else fetched_at
+        self.__by_id: Final[Dict[str, dict]] = {unit["_id"]: unit for unit in units}
+        self.__by_name: Final[Dict[str, dict]] = {unit["name"]: unit for unit in units}
+
+    def __len__(self) -> int:
+        return len(self.units)
+
+    def get(self, unit_id: str) -> Optional[dict]:
+        return self.__by_id.get(unit_id)
+
+    def get_by_name(self, name: str) -> Optional[dict]:
+        return self.__by_name.get(name)
+
+    def name_of(self, unit_id: str) -> str:
+        return self.__by_id[unit_id]["name"]
+
+    def is_fresh(self, ttl: float = UNIT_DIRECTORY_TTL) -> bool:
+        return time.time() - self.fetched_at < ttl
+
+    def save(self, path: str) -> None:
+        with atomic_write(path) as f:
+            json.dump({"fetchedAt": self.fetched_at, "units": self.units}, f, separators=(",", ":"))
+
+    @staticmethod
+    def load(path: str, ttl: float = UNIT_DIRECTORY_TTL) -> Optional['UnitDirectory']:
+        try:
+            with open(path) as f:
+                saved = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+        directory = UnitDirectory(saved["units"], saved["fetchedAt"])
+        return directory if directory.is_fresh(ttl) else None
@@ -1,22 +1,159 @@
+import logging
+import queue
 import smtplib
 import ssl
+import threading
+import time
 from email.message import Message
+from typing import Final, List, NamedTuple, Optional
 
 from environs import Env
 
+from metrics import METRICS
+
+log = logging.getLogger()
+
+DEFAULT_SMTP_CONNECTIONS: Final[int] = 2
+SMTP_MAX_ATTEMPTS: Final[int] = 3
+SMTP_RETRY_DELAY: Final[float] = 1.0
+SMTP_TIMEOUT: Final[float] = 30.0
+
+
+class SmtpSettings(NamedTuple):
+    server: str
+    port: int
+    username: Optional[str] = None
+    password: Optional[str] = None
+    # Local stand-ins for tests speak plain SMTP without TLS or a login
+    starttls: bool = True
+
+    @staticmethod
+    def from_env(env: Env) -> 'SmtpSettings':
+        with env.prefixed("SMTP_"):
+            return SmtpSettings(env.str("SERVER"), env.int("PORT"), env.str("USERNAME", "") or None,
+                                env.str("PASSWORD", "") or None, env.bool("STARTTLS", True))
+
+
+class DeliveryResult(NamedTuple):
+    message: Message
+    reference: Optional[str] = None
+    error: Optional[Exception] = None
+
+    @property
+    def succeeded(self) -> bool:
+        return self.error is None
+
+
+# Errors after which the connection cannot be trusted; the message is retried on a new one
+_CONNECTION_ERRORS: Final[tuple] = (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError,
+                                    smtplib.SMTPHeloError, OSError)
+
+
+class NotificationDispatcher:
+    # Sends queued messages over a small pool of authenticated SMTP connections. Each worker thread opens
+    # its connection on first use, keeps it for every message after that, and reconnects if it drops.
+    def __init__(self, settings: SmtpSettings, connections: int = DEFAULT_SMTP_CONNECTIONS,
+                 max_attempts: int = SMTP_MAX_ATTEMPTS, retry_delay: float = SMTP_RETRY_DELAY) -> None:
+        self.__settings: Final[SmtpSettings] = settings
+        self.__max_attempts: Final[int] = max_attempts
+        self.__retry_delay: Final[float] = retry_delay
+        # Bounded so a large batch waits for the workers instead of piling up in memory
+        self.__queue: Final[queue.Queue] = queue.Queue(maxsize=connections * 16)
+        self.__results: Final[List[DeliveryResult]] = []
+        self.__lock: Final[threading.Lock] = threading.Lock()
+        self.__closed = False
+        self.__workers: Final[List[threading.Thread]] = [
+            threading.Thread(target=self.__work, name=f"smtp-{n}", daemon=True) for n in range(connections)
+        ]
+        for worker in self.__workers:
+            worker.start()
+
+    def __enter__(self) -> 'NotificationDispatcher':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def send(self, message: Message, reference: Optional[str] = None) -> None:
+        self.__queue.put((message, reference))
+
+    def close(self) -> List[DeliveryResult]:
+        # Workers stop once they reach their sentinel, after every message queued before it
+        if not self.__closed:
+            self.__closed = True
+            for _ in self.__workers:
+                self.__queue.put(None)
+        for worker in self.__workers:
+            worker.join()
+        with self.__lock:
+            return list(self.__results)
+
+    def __connect(self) -> smtplib.SMTP:
+        with METRICS.span("smtp_connect"):
+            connection = smtplib.SMTP(self.__settings.server, self.__settings.port, timeout=SMTP_TIMEOUT)
+            try:
+                if self.__settings.starttls:
+                    connection.starttls(context=ssl.create_default_context())
+                if self.__settings.username is not None:
+                    connection.login(self.__settings.username, self.__settings.password)
+            except BaseException:
+                connection.close()
+                raise
+        return connection
+
+    def __deliver(self, connection: Optional[smtplib.SMTP], message: Message) -> smtplib.SMTP:
+        attempt = 1
+        while True:
+            try:
+                if connection is None:
+                    connection = self.__connect()
+                connection.send_message(message)
+                return connection
+            except _CONNECTION_ERRORS as e:
+                if connection is not None:
+                    connection.close()
+                    connection = None
+                if attempt >= self.__max_attempts:
+                    raise e
+                log.warning(f"SMTP connection failed, reconnecting: {e}")
+                METRICS.increment("smtp_reconnects")
+                time.sleep(self.__retry_delay * attempt)
+                attempt += 1
+
+    def __work(self) -> None:
+        connection: Optional[smtplib.SMTP] = None
+        while True:
+            item = self.__queue.get()
+            if item is None:
+                break
+
+            message, reference = item
+            error: Optional[Exception] = None
+            try:
+                connection = self.__deliver(connection, message)
+            except _CONNECTION_ERRORS as e:
+                connection, error = None, e
+            except smtplib.SMTPException as e:
+                # Refused senders or recipients only fail this message; the connection is still usable
+                error = e
+
+            METRICS.increment("notifications", outcome="failed" if error else "sent")
+            with self.__lock:
+                self.__results.append(DeliveryResult(message, reference, error))
+
+        if connection is not None:
+            try:
+                connection.quit()
+            except _CONNECTION_ERRORS + (smtplib.SMTPException,):
+                connection.close()
+
 
 def email(message: Message):
     env = Env()
     env.read_env()
 
-    with env.prefixed("SMTP_"):
-        port = env.int("PORT")
-        server = env.str("SERVER")
-        username = env.str("USERNAME")
-        password = env.str("PASSWORD")
-
-    context = ssl.create_default_context()
-    with smtplib.SMTP(server, port) as server:
-        server.starttls(context=context)
-        server.login(username, password)
-        server.send_message(message)
+    dispatcher = NotificationDispatcher(SmtpSettings.from_env(env), connections=1)
+    dispatcher.send(message)
+    result, = dispatcher.close()
+    if result.error is not None:
+        raise result.error
@@ -0,0 +1,13 @@
+from functools import lru_cache
+from typing import Any, Optional
+
+
+@lru_cache(maxsize=None)
+def optional_numpy() -> Optional[Any]:
+    # NumPy speeds up bill and usage calculations for large properties but is not required; it is imported the
+    # first time it is needed so commands that never calculate do not pay for it
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
@@ -1,23 +1,84 @@
 import json
-import time
-from functools import cache
-from http.cookies import SimpleCookie
-from typing import Final, List
+import math
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from http.cookiejar import CookieJar, Cookie, DefaultCookiePolicy
+from typing import Final, List, NamedTuple, Optional, Iterator, Callable
 from urllib.parse import unquote
 
 import requests
-from requests import Session
+from requests import Session, PreparedRequest
 
-from pay_hoa.shapes import CreateChargeRequest
+from credentials import CredentialStore, Credentials, SessionAuth, dump_cookies, latest_cookie, load_cookies, \
+    token_expiry
+from metadata import MetadataCache
+from metrics import METRICS, instrument_session
+from pay_hoa.reconciliation import IssuedChargeIndex, window_of
+from pay_hoa.shapes import CreateChargeRequest, Charge, format_date
+from throttle import RATE_LIMITER, RateLimit, ThrottledAdapter
 
 base_url: Final[str] = "https://core.payhoa.com"
 
+DEFAULT_PER_PAGE: Final[int] = 200
+DEFAULT_PAGE_WORKERS: Final[int] = 4
+
+DEFAULT_CHARGE_CHUNK_SIZE: Final[int] = 25
+# Charge chunks used to be sent a fixed 2.5 seconds apart; now the limiter adapts to what PayHOA allows
+DEFAULT_RATE_LIMIT: Final[RateLimit] = RateLimit(rate=2.0, burst=DEFAULT_PAGE_WORKERS, max_rate=10.0)
+
+
+class ChargeResult(NamedTuple):
+    charge: Charge
+    error: Optional[Exception] = None
+
+    @property
+    def succeeded(self) -> bool:
+        return self.error is None
+
+
+def last_page_of(page: dict, per_page: int) -> Optional[int]:
+    # Laravel paginators report the page count either at the top level or under "meta"
+    for meta in (page, page.get("meta") or {}):
+        if meta.get("last_page") is not None:
+            return int(meta["last_page"])
+        if meta.get("total") is not None:
+            return max(1, math.ceil(int(meta["total"]) / per_page))
+
+    return None
+
+
+class XsrfCookiePolicy(DefaultCookiePolicy):
+    # The default policy drops the XSRF-TOKEN cookie PayHOA sets on API responses, which used to force hand
+    # parsing of every Set-Cookie header. It is only ever echoed back in a header, so accept it as sent.
+    def set_ok(self, cookie: Cookie, request) -> bool:
+        return cookie.name == "XSRF-TOKEN" or super().set_ok(cookie, request)
+
+
+class PayHOAAuth(SessionAuth):
+    def __init__(self, cookies: CookieJar, login: Callable[[int], None], api_url: str = base_url) -> None:
+        # 419 is Laravel's response to a stale XSRF token
+        super().__init__(api_url, cookies, login, "pay_hoa", rejected_statuses=(401, 419))
+        self.jwt: Optional[str] = None
+
+    def add_credentials(self, request: PreparedRequest) -> None:
+        if self.jwt is not None:
+            request.headers["Authorization"] = f"Bearer {self.jwt}"
+        # Every response refreshes the XSRF-TOKEN cookie, and the API expects it echoed back as a header
+        xsrf_token = latest_cookie(self.cookies, "XSRF-TOKEN")
+        if xsrf_token is not None:
+            request.headers["X-XSRF-TOKEN"] = unquote(xsrf_token)
 
-class PayHOA:
-    __last_xsrf_token = None
 
-    def __init__(self, email: str, password: str, organization_id: int) -> None:
+class PayHOA:
+    def __init__(self, email: str, password: str, organization_id: int, api_url: str = base_url,
+                 credential_store: Optional[CredentialStore] = None, rate_limit: RateLimit = DEFAULT_RATE_LIMIT,
+                 metadata_cache: Optional[MetadataCache] = None) -> None:
+        self.__base_url: Final[str] = api_url
+        self.__email: Final[str] = email
+        self.__password: Final[str] = password
+        self.__credential_store: Final[Optional[CredentialStore]] = credential_store
         self.__organization_id: Final[int] = organization_id
+        self.__metadata_cache: Final[MetadataCache] = metadata_cache or MetadataCache()
         self.__session: Session = requests.sessions.Session()
         default_headers = {
            "X-Legfi-Site-Id": "2",
@@ -29,67 +90,147 @@ class PayHOA:
 
         for h, v in default_headers.items():
             self.__session.headers[h] = v
-
-        csrf_token_req = self.__session.get(f"{base_url}/sanctum/csrf-cookie")
+        self.__session.cookies.set_policy(XsrfCookiePolicy())
+        RATE_LIMITER.configure(api_url, rate_limit)
+        adapter = ThrottledAdapter("pay_hoa")
+        self.__session.mount("https://", adapter)
+        self.__session.mount("http://", adapter)
+        instrument_session(self.__session, "pay_hoa")
+
+        self.__auth: PayHOAAuth = PayHOAAuth(self.__session.cookies, self.__login, self.__base_url)
+        self.__session.auth = self.__auth
+
+        credentials = credential_store.get(api_url, email) if credential_store is not None else None
+        if credentials is None:
+            self.__auth.authenticate()
+        else:
+            self.__auth.jwt = credentials.token
+            load_cookies(self.__session.cookies, credentials.cookies)
+
+    def __login(self, status_code: int) -> None:
+        csrf_token_req = self.__session.get(f"{self.__base_url}/sanctum/csrf-cookie")
         csrf_token_req.raise_for_status()
 
-        # For reasons beyond my understanding, the cookies returned in csrf_token_req are not added
-        # to the Session Cookie Jar automatically
-        self.extract_and_update_cookies(csrf_token_req)
-
-        login_response = self.__session.post(f"{base_url}/login", json={
-            "email": email, "password": password, "siteId": 2
-        }, headers={
-            "X-XSRF-TOKEN": self.__last_xsrf_token
-        })
-
-        login_response.raise_for_status()
-        self.extract_and_update_cookies(login_response)
-
-        jwt = login_response.json()["token"]
-        self.__session.headers["Authorization"] = f"Bearer {jwt}"
-
-    def extract_and_update_cookies(self, request):
-        cookie = SimpleCookie()
-        cookie.load(request.headers.get("Set-Cookie"))
-        for k, v in cookie.items():
-            if k == "XSRF-TOKEN":
-                self.__last_xsrf_token = unquote(v.value)
-
-    def list_units(self) -> List[dict]:
-        response = self.__session.get(f"{base_url}/organizations/{self.__organization_id}/units",
-                                params={
-                                    "page": 1, "search": "", "column": "name", "direction": "asc", "perPage": 200,
-                                    "tags": "", "withoutTags": ""
-                                })
+        # A stale XSRF token only needs a fresh cookie, anything else needs a new login
+        if status_code != 419 or self.__auth.jwt is None:
+            login_response = self.__session.post(f"{self.__base_url}/login", json={
+                "email": self.__email, "password": self.__password, "siteId": 2
+            })
+
+            login_response.raise_for_status()
+            self.__auth.jwt = login_response.json()["token"]
+
+        if self.__credential_store is not None:
+            self.__credential_store.put(self.__base_url, self.__email, Credentials(
+                self.__auth.jwt, dump_cookies(self.__session.cookies), token_expiry(self.__auth.jwt)))
+
+    def for_organization(self, organization_id: int) -> 'PayHOA':
+        # Logins are per user rather than per organization, so other organizations can share this session
+        client: PayHOA = PayHOA.__new__(PayHOA)
+        client.__base_url = self.__base_url
+        client.__email = self.__email
+        client.__password = self.__password
+        client.__credential_store = self.__credential_store
+        client.__organization_id = organization_id
+        client.__metadata_cache = self.__metadata_cache
+        client.__session = self.__session
+        client.__auth = self.__auth
+        return client
+
+    def __get_page(self, path: str, params: dict, page: int, per_page: int) -> dict:
+        response = self.__session.get(f"{self.__base_url}{path}", params={**params, "page": page, "perPage": per_page})
 
         response.raise_for_status()
-        self.extract_and_update_cookies(response)
-        return response.json()["data"]
-
-    def create_charge(self, request: CreateChargeRequest):
-        response = self.__session.post(f"{base_url}/charges",
+        return response.json()
+
+    def __iter_pages(self, path: str, params: dict, per_page: int, max_workers: int) -> Iterator[dict]:
+        first_page = self.__get_page(path, params, 1, per_page)
+        yield from first_page["data"]
+
+        last_page = last_page_of(first_page, per_page)
+        if last_page is None:
+            # Without pagination metadata, keep walking pages until one comes back short
+            page_number, page = 1, first_page
+            while len(page["data"]) >= per_page:
+                page_number += 1
+                page = self.__get_page(path, params, page_number, per_page)
+                yield from page["data"]
+            return
+
+        if last_page < 2:
+            return
+
+        with ThreadPoolExecutor(max_workers=min(max_workers, last_page - 1)) as executor:
+            for page in executor.map(lambda n: self.__get_page(path, params, n, per_page), range(2, last_page + 1)):
+                yield from page["data"]
+
+    def list_units(self, per_page: int = DEFAULT_PER_PAGE, max_workers: int = DEFAULT_PAGE_WORKERS,
+                   ttl: Optional[float] = None) -> Iterator[dict]:
+        path = f"/organizations/{self.__organization_id}/units"
+        return iter(self.__metadata_cache.get_or_load(f"{self.__email}|{self.__base_url}{path}", lambda: list(
+            self.__iter_pages(path, {
+                "search": "", "column": "name", "direction": "asc", "tags": "", "withoutTags": ""
+            }, per_page, max_workers)), ttl))
+
+    def list_charges(self, start: date, end: date, per_page: int = DEFAULT_PER_PAGE,
+                     max_workers: int = DEFAULT_PAGE_WORKERS) -> Iterator[dict]:
+        # Unit charges that become active between start and end inclusive
+        return self.__iter_pages(f"/organizations/{self.__organization_id}/charges", {
+            "payorType": "unit", "activeAfterStart": format_date(start), "activeAfterEnd": format_date(end)
+        }, per_page, max_workers)
+
+    def index_issued_charges(self, charges: List[Charge], per_page: int = DEFAULT_PER_PAGE,
+                             max_workers: int = DEFAULT_PAGE_WORKERS) -> IssuedChargeIndex:
+        if not charges:
+            return IssuedChargeIndex((date.min, date.min))
+        window = window_of(charges)
+        with METRICS.span("pay_hoa_reconciliation"):
+            return IssuedChargeIndex(window, self.list_charges(*window, per_page, max_workers))
+
+    def __post_charges(self, request: CreateChargeRequest):
+        response = self.__session.post(f"{self.__base_url}/charges",
                       params={
                           "queue": True
                       },
-                      json=request.to_dict(),
+                      data=request.to_json_bytes(),
                       headers={
-                          "X-XSRF-TOKEN": self.__last_xsrf_token
+                          "Content-Type": "application/json"
                       })
 
         response.raise_for_status()
-        self.extract_and_update_cookies(response)
-        time.sleep(2.5)
 
-    @cache
-    def get_late_fee_category_id(self):
-        response = self.__session.get(f"{base_url}/accounting/v2/organizations/{self.__organization_id}/categories")
+    def create_charge(self, request: CreateChargeRequest):
+        self.__post_charges(request)
+
+    def iter_create_charges(self, request: CreateChargeRequest,
+                            chunk_size: int = DEFAULT_CHARGE_CHUNK_SIZE) -> Iterator[List[ChargeResult]]:
+        for offset in range(0, len(request.charges), chunk_size):
+            chunk = request.charges[offset:offset + chunk_size]
+            try:
+                with METRICS.span("pay_hoa_charge_chunk"):
+                    self.__post_charges(CreateChargeRequest(charges=chunk,
+                                                            templates=request.templates,
+                                                            invoice_message=request.invoice_message,
+                                                            payor_type=request.payor_type,
+                                                            organization_id=request.organization_id))
+            except requests.RequestException as e:
+                METRICS.increment("pay_hoa_charges", len(chunk), outcome="failed")
+                yield [ChargeResult(charge, e) for charge in chunk]
+            else:
+                METRICS.increment("pay_hoa_charges", len(chunk), outcome="created")
+                yield [ChargeResult(charge) for charge in chunk]
+
+    def create_charges(self, request: CreateChargeRequest,
+                       chunk_size: int = DEFAULT_CHARGE_CHUNK_SIZE) -> List[ChargeResult]:
+        return [result for chunk in self.iter_create_charges(request, chunk_size) for result in chunk]
 
-        response.raise_for_status()
-        self.extract_and_update_cookies(response)
+    def get_late_fee_category_id(self):
+        categories = self.__metadata_cache.get_json(
+            self.__session, f"{self.__base_url}/accounting/v2/organizations/{self.__organization_id}/categories",
+            scope=self.__email)
 
         flattened_categories = []
-        for cat in response.json():
+        for cat in categories:
             flattened_categories.append(cat)
             flattened_categories.extend(cat.get("children", []))
 
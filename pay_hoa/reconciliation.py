@@ -0,0 +1,46 @@
+import calendar
+from datetime import date
+from typing import Final, Iterable, NamedTuple, Set, Tuple
+
+from pay_hoa.shapes import Charge
+
+
+class ChargeKey(NamedTuple):
+    payor_id: int
+    # The month the charge becomes active in, as YYYY-MM; a billing run issues one charge per payor each month
+    period: str
+    amount: int
+
+
+def period_of(active_after: date) -> str:
+    return "%04d-%02d" % (active_after.year, active_after.month)
+
+
+def charge_key(charge: Charge) -> ChargeKey:
+    return ChargeKey(charge.payor_id, period_of(charge.active_after), charge.charge_amount)
+
+
+def issued_charge_key(record: dict) -> ChargeKey:
+    # Issued charges come back in the same shape they are created in
+    return ChargeKey(int(record["payorId"]), record["activeAfter"][:7], int(record["chargeAmount"]))
+
+
+def window_of(charges: Iterable[Charge]) -> Tuple[date, date]:
+    # The whole months the charges become active in, so the index holds every charge that could match one
+    days = [charge.active_after for charge in charges]
+    start, end = min(days), max(days)
+    return date(start.year, start.month, 1), date(end.year, end.month, calendar.monthrange(end.year, end.month)[1])
+
+
+class IssuedChargeIndex:
+    # The charges already issued in a window, so planned charges can be checked against them without asking
+    # the API about each unit
+    def __init__(self, window: Tuple[date, date], records: Iterable[dict] = ()) -> None:
+        self.window: Final[Tuple[date, date]] = window
+        self.__keys: Final[Set[ChargeKey]] = {issued_charge_key(record) for record in records}
+
+    def __len__(self) -> int:
+        return len(self.__keys)
+
+    def __contains__(self, charge: Charge) -> bool:
+        return charge_key(charge) in self.__keys
@@ -1,38 +1,67 @@
-# Generated via https://codebeautify.org/json-to-python-pojo-generator
-
-from datetime import datetime
-from typing import Any, List, TypeVar, Callable, Type, cast
-import dateutil.parser
+# Originally generated via https://codebeautify.org/json-to-python-pojo-generator
 
+import json
+from datetime import datetime, date
+from json.encoder import encode_basestring_ascii as encode_str
+from typing import Any, List, TypeVar, Callable, Type
 
 T = TypeVar("T")
 
 
-def from_str(x: Any) -> str:
-    assert isinstance(x, str)
+def from_str(x: Any, name: str = "value") -> str:
+    if not isinstance(x, str):
+        raise TypeError(f"{name} must be a str, not {type(x).__name__}")
     return x
 
 
-def from_datetime(x: Any) -> datetime:
-    return dateutil.parser.parse(x)
+def from_int(x: Any, name: str = "value") -> int:
+    if not isinstance(x, int) or isinstance(x, bool):
+        raise TypeError(f"{name} must be an int, not {type(x).__name__}")
+    return x
 
 
-def from_int(x: Any) -> int:
-    assert isinstance(x, int) and not isinstance(x, bool)
+def from_date(x: Any, name: str = "value") -> date:
+    if not isinstance(x, date):
+        raise TypeError(f"{name} must be a date or datetime, not {type(x).__name__}")
     return x
 
 
-def from_list(f: Callable[[Any], T], x: Any) -> List[T]:
-    assert isinstance(x, list)
+def from_datetime(x: Any) -> datetime:
+    # PayHOA sends ISO 8601 dates, so only fall back to dateutil for anything else
+    try:
+        return datetime.fromisoformat(x)
+    except ValueError:
+        import dateutil.parser
+        return dateutil.parser.parse(x)
+
+
+def from_list(f: Callable[[Any], T], x: Any, name: str = "value") -> List[T]:
+    if not isinstance(x, list):
+        raise TypeError(f"{name} must be a list, not {type(x).__name__}")
     return [f(y) for y in x]
 
 
-def to_class(c: Type[T], x: Any) -> dict:
-    assert isinstance(x, c)
-    return cast(Any, x).to_dict()
+def from_instances(c: Type[T], x: Any, name: str = "value") -> List[T]:
+    if not isinstance(x, list):
+        raise TypeError(f"{name} must be a list, not {type(x).__name__}")
+    for y in x:
+        if not isinstance(y, c):
+            raise TypeError(f"{name} must only contain {c.__name__}, not {type(y).__name__}")
+    return x
+
+
+def format_date(d: date) -> str:
+    return "%04d-%02d-%02d" % (d.year, d.month, d.day)
+
+
+def encode_date(d: date) -> str:
+    return '"%04d-%02d-%02d"' % (d.year, d.month, d.day)
 
 
 class LateFee:
+    __slots__ = ("late_fee_type", "one_time_late_fee_type", "one_time_late_fee_applies", "one_time_late_fee_amount",
+                 "category_id")
+
     late_fee_type: str
     one_time_late_fee_type: str
     one_time_late_fee_applies: datetime
@@ -40,32 +69,42 @@ class LateFee:
     category_id: int
 
     def __init__(self, late_fee_type: str, one_time_late_fee_type: str, one_time_late_fee_applies: datetime, one_time_late_fee_amount: int, category_id: int) -> None:
-        self.late_fee_type = late_fee_type
-        self.one_time_late_fee_type = one_time_late_fee_type
-        self.one_time_late_fee_applies = one_time_late_fee_applies
-        self.one_time_late_fee_amount = one_time_late_fee_amount
-        self.category_id = category_id
+        self.late_fee_type = from_str(late_fee_type, "late_fee_type")
+        self.one_time_late_fee_type = from_str(one_time_late_fee_type, "one_time_late_fee_type")
+        self.one_time_late_fee_applies = from_date(one_time_late_fee_applies, "one_time_late_fee_applies")
+        self.one_time_late_fee_amount = from_int(one_time_late_fee_amount, "one_time_late_fee_amount")
+        self.category_id = from_int(category_id, "category_id")
 
     @staticmethod
     def from_dict(obj: Any) -> 'LateFee':
-        assert isinstance(obj, dict)
-        late_fee_type = from_str(obj.get("lateFeeType"))
-        one_time_late_fee_type = from_str(obj.get("oneTimeLateFeeType"))
-        one_time_late_fee_applies = from_datetime(obj.get("oneTimeLateFeeApplies"))
-        one_time_late_fee_amount = from_int(obj.get("oneTimeLateFeeAmount"))
-        category_id = from_int(obj.get("categoryId"))
-        return LateFee(late_fee_type, one_time_late_fee_type, one_time_late_fee_applies, one_time_late_fee_amount, category_id)
+        if not isinstance(obj, dict):
+            raise TypeError(f"LateFee must be a dict, not {type(obj).__name__}")
+        return LateFee(obj.get("lateFeeType"), obj.get("oneTimeLateFeeType"),
+                       from_datetime(obj.get("oneTimeLateFeeApplies")), obj.get("oneTimeLateFeeAmount"),
+                       obj.get("categoryId"))
 
     def to_dict(self) -> dict:
-        result: dict = {"lateFeeType": from_str(self.late_fee_type),
-                        "oneTimeLateFeeType": from_str(self.one_time_late_fee_type),
-                        "oneTimeLateFeeApplies": self.one_time_late_fee_applies.strftime("%Y-%m-%d"),
-                        "oneTimeLateFeeAmount": from_int(self.one_time_late_fee_amount),
-                        "categoryId": from_int(self.category_id)}
-        return result
+        return {"lateFeeType": self.late_fee_type,
+                "oneTimeLateFeeType": self.one_time_late_fee_type,
+                "oneTimeLateFeeApplies": format_date(self.one_time_late_fee_applies),
+                "oneTimeLateFeeAmount": self.one_time_late_fee_amount,
+                "categoryId": self.category_id}
+
+    def to_json(self) -> str:
+        return "".join((
+            '{"lateFeeType":', encode_str(self.late_fee_type),
+            ',"oneTimeLateFeeType":', encode_str(self.one_time_late_fee_type),
+            ',"oneTimeLateFeeApplies":', encode_date(self.one_time_late_fee_applies),
+            ',"oneTimeLateFeeAmount":', str(self.one_time_late_fee_amount),
+            ',"categoryId":', str(self.category_id),
+            '}'))
 
 
 class Charge:
+    __slots__ = ("deposit_bank_account_id", "category_id", "title", "description", "email_append_message", "currency",
+                 "charge_amount", "active_after", "payment_due_on", "late_fees", "reason", "email_invoice", "payor_id",
+                 "payor_type")
+
     deposit_bank_account_id: int
     category_id: int
     title: str
@@ -82,59 +121,69 @@ class Charge:
     payor_type: str
 
     def __init__(self, deposit_bank_account_id: int, category_id: int, title: str, description: str, email_append_message: str, currency: str, charge_amount: int, active_after: datetime, payment_due_on: datetime, late_fees: List[LateFee], reason: str, email_invoice: int, payor_id: int, payor_type: str) -> None:
-        self.deposit_bank_account_id = deposit_bank_account_id
-        self.category_id = category_id
-        self.title = title
-        self.description = description
-        self.email_append_message = email_append_message
-        self.currency = currency
-        self.charge_amount = charge_amount
-        self.active_after = active_after
-        self.payment_due_on = payment_due_on
-        self.late_fees = late_fees
-        self.reason = reason
-        self.email_invoice = email_invoice
-        self.payor_id = payor_id
-        self.payor_type = payor_type
+        self.deposit_bank_account_id = from_int(deposit_bank_account_id, "deposit_bank_account_id")
+        self.category_id = from_int(category_id, "category_id")
+        self.title = from_str(title, "title")
+        self.description = from_str(description, "description")
+        self.email_append_message = from_str(email_append_message, "email_append_message")
+        self.currency = from_str(currency, "currency")
+        self.charge_amount = from_int(charge_amount, "charge_amount")
+        self.active_after = from_date(active_after, "active_after")
+        self.payment_due_on = from_date(payment_due_on, "payment_due_on")
+        self.late_fees = from_instances(LateFee, late_fees, "late_fees")
+        self.reason = from_str(reason, "reason")
+        self.email_invoice = from_int(email_invoice, "email_invoice")
+        self.payor_id = from_int(payor_id, "payor_id")
+        self.payor_type = from_str(payor_type, "payor_type")
 
     @staticmethod
     def from_dict(obj: Any) -> 'Charge':
-        assert isinstance(obj, dict)
-        deposit_bank_account_id = from_int(obj.get("depositBankAccountId"))
-        category_id = from_int(obj.get("categoryId"))
-        title = from_str(obj.get("title"))
-        description = from_str(obj.get("description"))
-        email_append_message = from_str(obj.get("emailAppendMessage"))
-        currency = from_str(obj.get("currency"))
-        charge_amount = from_int(obj.get("chargeAmount"))
-        active_after = from_datetime(obj.get("activeAfter"))
-        payment_due_on = from_datetime(obj.get("paymentDueOn"))
-        late_fees = from_list(LateFee.from_dict, obj.get("lateFees"))
-        reason = from_str(obj.get("reason"))
-        email_invoice = from_int(obj.get("emailInvoice"))
-        payor_id = from_int(obj.get("payorId"))
-        payor_type = from_str(obj.get("payorType"))
-        return Charge(deposit_bank_account_id, category_id, title, description, email_append_message, currency, charge_amount, active_after, payment_due_on, late_fees, reason, email_invoice, payor_id, payor_type)
+        if not isinstance(obj, dict):
+            raise TypeError(f"Charge must be a dict, not {type(obj).__name__}")
+        return Charge(obj.get("depositBankAccountId"), obj.get("categoryId"), obj.get("title"), obj.get("description"),
+                      obj.get("emailAppendMessage"), obj.get("currency"), obj.get("chargeAmount"),
+                      from_datetime(obj.get("activeAfter")), from_datetime(obj.get("paymentDueOn")),
+                      from_list(LateFee.from_dict, obj.get("lateFees"), "lateFees"), obj.get("reason"),
+                      obj.get("emailInvoice"), obj.get("payorId"), obj.get("payorType"))
 
     def to_dict(self) -> dict:
-        result: dict = {"depositBankAccountId": from_int(self.deposit_bank_account_id),
-                        "categoryId": from_int(self.category_id),
-                        "title": from_str(self.title),
-                        "description": from_str(self.description),
-                        "emailAppendMessage": from_str(self.email_append_message),
-                        "currency": from_str(self.currency),
-                        "chargeAmount": from_int(self.charge_amount),
-                        "activeAfter": self.active_after.strftime("%Y-%m-%d"),
-                        "paymentDueOn": self.payment_due_on.strftime("%Y-%m-%d"),
-                        "lateFees": from_list(lambda x: to_class(LateFee, x), self.late_fees),
-                        "reason": from_str(self.reason),
-                        "emailInvoice": from_int(self.email_invoice),
-                        "payorId": from_int(self.payor_id),
-                        "payorType": from_str(self.payor_type)}
-        return result
+        return {"depositBankAccountId": self.deposit_bank_account_id,
+                "categoryId": self.category_id,
+                "title": self.title,
+                "description": self.description,
+                "emailAppendMessage": self.email_append_message,
+                "currency": self.currency,
+                "chargeAmount": self.charge_amount,
+                "activeAfter": format_date(self.active_after),
+                "paymentDueOn": format_date(self.payment_due_on),
+                "lateFees": [late_fee.to_dict() for late_fee in self.late_fees],
+                "reason": self.reason,
+                "emailInvoice": self.email_invoice,
+                "payorId": self.payor_id,
+                "payorType": self.payor_type}
+
+    def to_json(self) -> str:
+        return "".join((
+            '{"depositBankAccountId":', str(self.deposit_bank_account_id),
+            ',"categoryId":', str(self.category_id),
+            ',"title":', encode_str(self.title),
+            ',"description":', encode_str(self.description),
+            ',"emailAppendMessage":', encode_str(self.email_append_message),
+            ',"currency":', encode_str(self.currency),
+            ',"chargeAmount":', str(self.charge_amount),
+            ',"activeAfter":', encode_date(self.active_after),
+            ',"paymentDueOn":', encode_date(self.payment_due_on),
+            ',"lateFees":[', ",".join([late_fee.to_json() for late_fee in self.late_fees]),
+            '],"reason":', encode_str(self.reason),
+            ',"emailInvoice":', str(self.email_invoice),
+            ',"payorId":', str(self.payor_id),
+            ',"payorType":', encode_str(self.payor_type),
+            '}'))
 
 
 class CreateChargeRequest:
+    __slots__ = ("charges", "templates", "invoice_message", "payor_type", "organization_id")
+
     charges: List[Charge]
     templates: List[Any]
     invoice_message: str
@@ -142,26 +191,35 @@ class CreateChargeRequest:
     organization_id: int
 
     def __init__(self, charges: List[Charge], templates: List[Any], invoice_message: str, payor_type: str, organization_id: int) -> None:
-        self.charges = charges
-        self.templates = templates
-        self.invoice_message = invoice_message
-        self.payor_type = payor_type
-        self.organization_id = organization_id
+        self.charges = from_instances(Charge, charges, "charges")
+        self.templates = from_instances(object, templates, "templates")
+        self.invoice_message = from_str(invoice_message, "invoice_message")
+        self.payor_type = from_str(payor_type, "payor_type")
+        self.organization_id = from_int(organization_id, "organization_id")
 
     @staticmethod
     def from_dict(obj: Any) -> 'CreateChargeRequest':
-        assert isinstance(obj, dict)
-        charges = from_list(Charge.from_dict, obj.get("charges"))
-        templates = from_list(lambda x: x, obj.get("templates"))
-        invoice_message = from_str(obj.get("invoiceMessage"))
-        payor_type = from_str(obj.get("payorType"))
-        organization_id = from_int(obj.get("organizationId"))
-        return CreateChargeRequest(charges, templates, invoice_message, payor_type, organization_id)
+        if not isinstance(obj, dict):
+            raise TypeError(f"CreateChargeRequest must be a dict, not {type(obj).__name__}")
+        return CreateChargeRequest(from_list(Charge.from_dict, obj.get("charges"), "charges"), obj.get("templates"),
+                                   obj.get("invoiceMessage"), obj.get("payorType"), obj.get("organizationId"))
 
     def to_dict(self) -> dict:
-        result: dict = {"charges": from_list(lambda x: to_class(Charge, x), self.charges),
-                        "templates": from_list(lambda x: x, self.templates),
-                        "invoiceMessage": from_str(self.invoice_message),
-                        "payorType": from_str(self.payor_type),
-                        "organizationId": from_int(self.organization_id)}
-        return result
\ No newline at end of file
+        return {"charges": [charge.to_dict() for charge in self.charges],
+                "templates": list(self.templates),
+                "invoiceMessage": self.invoice_message,
+                "payorType": self.payor_type,
+                "organizationId": self.organization_id}
+
+    def to_json(self) -> str:
+        return "".join((
+            '{"charges":[', ",".join([charge.to_json() for charge in self.charges]),
+            '],"templates":', json.dumps(self.templates, separators=(",", ":")),
+            ',"invoiceMessage":', encode_str(self.invoice_message),
+            ',"payorType":', encode_str(self.payor_type),
+            ',"organizationId":', str(self.organization_id),
+            '}'))
+
+    def to_json_bytes(self) -> bytes:
+        # encode_str escapes everything outside ASCII, so the document is always plain ASCII
+        return self.to_json().encode("ascii")
@@ -0,0 +1,52 @@
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from typing import Final, Any, Callable, Dict, Tuple
+
+from metrics import METRICS
+
+DEFAULT_PIPELINE_WORKERS: Final[int] = 6
+
+
+class Pipeline:
+    # A graph of named stages run on a thread pool. Each stage starts as soon as every stage it depends on has
+    # finished and receives their results as arguments, so the run takes as long as its slowest chain of
+    # dependent stages rather than the sum of all of them.
+    def __init__(self, max_workers: int = DEFAULT_PIPELINE_WORKERS) -> None:
+        self.__max_workers: Final[int] = max_workers
+        self.__stages: Final[Dict[str, Tuple[Callable[..., Any], Tuple[str, ...]]]] = {}
+        self.__values: Final[Dict[str, Any]] = {}
+
+    def value(self, name: str, value: Any) -> 'Pipeline':
+        self.__values[name] = value
+        return self
+
+    def stage(self, name: str, function: Callable[..., Any], *dependencies: str) -> 'Pipeline':
+        self.__stages[name] = (function, dependencies)
+        return self
+
+    @staticmethod
+    def __run_stage(name: str, function: Callable[..., Any], arguments: list) -> Any:
+        with METRICS.span("stage", stage=name):
+            return function(*arguments)
+
+    def run(self) -> Dict[str, Any]:
+        results: Dict[str, Any] = dict(self.__values)
+        pending = dict(self.__stages)
+        running: Dict[Future, str] = {}
+
+        with ThreadPoolExecutor(max_workers=self.__max_workers, thread_name_prefix="stage") as executor:
+            while pending or running:
+                for name, (function, dependencies) in list(pending.items()):
+                    if all(dependency in results for dependency in dependencies):
+                        del pending[name]
+                        running[executor.submit(self.__run_stage, name, function,
+                                                [results[dependency] for dependency in dependencies])] = name
+
+                if not running:
+                    raise ValueError(f"Stages {', '.join(pending)} depend on stages that do not exist")
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    # A failed stage fails the run; stages already running finish before the error is raised
+                    results[running.pop(future)] = future.result()
+
+        return results
@@ -0,0 +1,68 @@
+import json
+from datetime import date, datetime
+from typing import Final, Dict, Iterator, NamedTuple, Optional, Tuple, List
+
+from pay_hoa.shapes import CreateChargeRequest, Charge, encode_str
+
+PLAN_VERSION: Final[int] = 1
+
+
+class PlanHeader(NamedTuple):
+    property_id: str
+    organization_id: int
+    billing_period: Tuple[date, date]
+    invoice_date: datetime
+    invoice_message: str
+    payor_type: str
+    # Units left out of the plan because their meters could not be billed, with the reason
+    skipped_units: Dict[str, str]
+
+
+def write_plan(path: str, property_id: str, charge_request: CreateChargeRequest, units: List[str],
+               billing_period: Tuple[date, date], invoice_date: datetime,
+               skipped_units: Optional[Dict[str, str]] = None) -> None:
+    # The first line describes the run, each following line holds one unit's charge
+    with open(path, "w") as f:
+        f.write(json.dumps({
+            "version": PLAN_VERSION,
+            "propertyId": property_id,
+            "organizationId": charge_request.organization_id,
+            "periodStart": billing_period[0].isoformat(),
+            "periodEnd": billing_period[1].isoformat(),
+            "invoiceDate": invoice_date.isoformat(),
+            "invoiceMessage": charge_request.invoice_message,
+            "payorType": charge_request.payor_type,
+            "skippedUnits": skipped_units or {},
+        }, separators=(",", ":")) + "\n")
+        for unit, charge in zip(units, charge_request.charges):
+            f.write(f'{{"unit":{encode_str(unit)},"charge":{charge.to_json()}}}\n')
+
+
+def read_plan_header(path: str) -> PlanHeader:
+    with open(path) as f:
+        header = json.loads(f.readline())
+
+    if header.get("version") != PLAN_VERSION:
+        raise ValueError(f"Unsupported plan version {header.get('version')} in {path}")
+
+    return PlanHeader(header["propertyId"], header["organizationId"],
+                      (date.fromisoformat(header["periodStart"]), date.fromisoformat(header["periodEnd"])),
+                      datetime.fromisoformat(header["invoiceDate"]), header["invoiceMessage"], header["payorType"],
+                      header.get("skippedUnits") or {})
+
+
+def iter_plan_charges(path: str) -> Iterator[Tuple[str, Charge]]:
+    with open(path) as f:
+        f.readline()
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                yield entry["unit"], Charge.from_dict(entry["charge"])
+
+
+def read_plan(path: str) -> Tuple[PlanHeader, CreateChargeRequest, List[str]]:
+    header = read_plan_header(path)
+    charges: Dict[str, Charge] = dict(iter_plan_charges(path))
+    return header, CreateChargeRequest(charges=list(charges.values()), templates=[],
+                                       invoice_message=header.invoice_message, payor_type=header.payor_type,
+                                       organization_id=header.organization_id), list(charges.keys())
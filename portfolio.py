@@ -0,0 +1,150 @@
+import json
+import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+from email.message import EmailMessage
+from textwrap import dedent
+from typing import Final, List, Tuple, Optional
+
+from environs import Env
+
+import notify
+from journal import RunJournal
+from main import BillingTarget, BillRunResult, bill_property, get_billing_period, get_invoice_date, write_metrics, \
+    next_century_login, pay_hoa_login, send_usage_emails, describe_skipped_units
+from metrics import METRICS
+from next_century.client import NextCentury
+from pay_hoa.client import PayHOA, DEFAULT_CHARGE_CHUNK_SIZE
+from pipeline import Pipeline
+
+log = logging.getLogger()
+
+DEFAULT_MAX_WORKERS: Final[int] = 4
+
+
+def load_targets(path: str) -> List[BillingTarget]:
+    # [{"propertyId": "...", "organizationId": 1, "depositAccount": 2, "categoryId": 3}, ...]
+    with open(path) as f:
+        return [BillingTarget(entry["propertyId"], int(entry["organizationId"]), int(entry["depositAccount"]),
+                              int(entry["categoryId"])) for entry in json.load(f)]
+
+
+def bill_target(next_century: NextCentury, pay_hoa: PayHOA, target: BillingTarget,
+                billing_period: Tuple[date, date], invoice_date: datetime, cache_dir: str,
+                chunk_size: int, journal_dir: Optional[str]) -> BillRunResult:
+    try:
+        journal = RunJournal.for_period(journal_dir, target.property_id, target.organization_id, billing_period) \
+            if journal_dir else None
+        return bill_property(next_century, pay_hoa.for_organization(target.organization_id), target,
+                             billing_period, invoice_date, cache_dir, chunk_size, journal)
+    except Exception as e:
+        log.exception(f"Billing failed for property {target.property_id}")
+        return BillRunResult(target, [], [], {}, f"{type(e).__name__}: {e}")
+
+
+def run_portfolio(next_century: NextCentury, pay_hoa: PayHOA, targets: List[BillingTarget],
+                  billing_period: Tuple[date, date], invoice_date: datetime, cache_dir: str,
+                  max_workers: int = DEFAULT_MAX_WORKERS, chunk_size: int = DEFAULT_CHARGE_CHUNK_SIZE,
+                  journal_dir: Optional[str] = None) -> List[BillRunResult]:
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(targets)))) as executor:
+        return list(executor.map(lambda t: bill_target(next_century, pay_hoa, t, billing_period, invoice_date,
+                                                       cache_dir, chunk_size, journal_dir), targets))
+
+
+def build_report(results: List[BillRunResult], billing_period: Tuple[date, date]) -> dict:
+    return {
+        "periodStart": billing_period[0].isoformat(),
+        "periodEnd": billing_period[1].isoformat(),
+        "succeeded": all(r.succeeded for r in results),
+        "needsAttention": any(r.needs_attention for r in results),
+        "properties": [{
+            "propertyId": r.target.property_id,
+            "organizationId": r.target.organization_id,
+            "invoicedUnits": r.invoiced_units,
+            "failedUnits": r.failed_units,
+            "skippedUnits": r.skipped_units,
+            "error": r.error,
+        } for r in results]
+    }
+
+
+def main():
+    env = Env()
+    env.read_env()
+    try:
+        with METRICS.span("phase", phase="total"):
+            run(env)
+    finally:
+        write_metrics(env)
+
+
+def run(env: Env):
+    cache_dir: Final[str] = env.str("CACHE_DIR", ".cache")
+    targets = load_targets(env.str("PORTFOLIO_FILE"))
+    logins = Pipeline() \
+        .stage("next_century", next_century_login(env, cache_dir)) \
+        .stage("pay_hoa", pay_hoa_login(env, targets[0].organization_id, cache_dir)) \
+        .run()
+    next_century, pay_hoa = logins["next_century"], logins["pay_hoa"]
+    chunk_size = env.int("PAY_HOA_CHARGE_CHUNK_SIZE", DEFAULT_CHARGE_CHUNK_SIZE)
+
+    billing_period = get_billing_period()
+    invoice_date = get_invoice_date()
+    log.info(f"Billing {len(targets)} properties for Period {billing_period[0].strftime('%m/%d/%Y')} - "
+             f"{billing_period[1].strftime('%m/%d/%Y')}")
+    journal_dir = env.str("JOURNAL_DIR", "journal")
+    results = run_portfolio(next_century, pay_hoa, targets, billing_period, invoice_date, cache_dir,
+                            env.int("PORTFOLIO_MAX_WORKERS", DEFAULT_MAX_WORKERS), chunk_size, journal_dir)
+    failed_emails = send_usage_emails(env, [
+        (r.target, RunJournal.for_period(journal_dir, r.target.property_id, r.target.organization_id, billing_period),
+         r.invoiced_units) for r in results if r.invoiced_units
+    ], billing_period, invoice_date)
+
+    report = build_report(results, billing_period)
+    with open(env.str("PORTFOLIO_REPORT", "portfolio-report.json"), "w") as f:
+        json.dump(report, f, indent=2)
+
+    summary = "\n".join(
+        f"  - Property {r.target.property_id} (organization {r.target.organization_id}): "
+        f"{len(r.invoiced_units)} invoiced"
+        + (f", {len(r.failed_units)} failed ({', '.join(r.failed_units)})" if r.failed_units else "")
+        + (f", {len(r.skipped_units)} not billed ({describe_skipped_units(r.skipped_units)})"
+           if r.skipped_units else "")
+        + (f", error: {r.error}" if r.error else "")
+        for r in results)
+    if failed_emails:
+        summary += f"\n  - Usage emails failed for {', '.join(failed_emails)}"
+    needs_attention = report["needsAttention"] or bool(failed_emails)
+    msg = EmailMessage()
+    msg['Subject'] = f"Utility Bill Run {'Needs Attention' if needs_attention else 'Completed'} for " \
+                     f"{billing_period[0].strftime('%b %Y')}"
+    msg['From'] = env.str("NOTIFICATION_SENDER")
+    msg['To'] = (env.str("NOTIFICATION_EMAIL"),)
+    msg.set_content(dedent("""\
+        Hi there,
+
+        Utility bills have been generated for {count} properties:
+
+        {summary}
+
+        Please verify that bills are accurate before they are published on {published}.
+
+        View Invoices at https://app.payhoa.com/app/charges/organization/issued
+
+        Cheers,
+        Auto-Bill""").format(count=len(results), summary=summary,
+                             published=invoice_date.strftime('%m/%d/%Y at %I:%M %p %Z').strip()))
+    notify.email(msg)
+    log.info("Notification Email Sent")
+
+    if not report["succeeded"]:
+        raise RuntimeError("One or more properties failed to bill, see the portfolio report")
+    if failed_emails:
+        raise RuntimeError(f"Failed to send usage emails for {', '.join(failed_emails)}")
+    log.info("All Done! 🎉")
+
+
+if __name__ == '__main__':
+    import cli
+    sys.exit(cli.main(["portfolio"]))
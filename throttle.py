@@ -0,0 +1,193 @@
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Final, Dict, NamedTuple, Optional
+from urllib.parse import urlsplit
+
+import requests
+from requests import PreparedRequest, Response
+from requests.adapters import HTTPAdapter
+
+from metrics import METRICS
+
+# Methods that can be sent again without doing the work twice
+IDEMPOTENT_METHODS: Final[frozenset] = frozenset(("GET", "HEAD", "OPTIONS", "PUT", "DELETE"))
+# Server errors worth another try; a 429 is always retried because the request was not processed
+RETRY_STATUSES: Final[frozenset] = frozenset((500, 502, 503, 504))
+THROTTLED_STATUS: Final[int] = 429
+
+DEFAULT_MAX_ATTEMPTS: Final[int] = 4
+RETRY_BACKOFF: Final[float] = 0.5
+RETRY_MAX_BACKOFF: Final[float] = 30.0
+# Longest Retry-After honored before giving up on the request
+MAX_RETRY_AFTER: Final[float] = 120.0
+
+# Every request earns this fraction of a retry, on top of a floor, so a failing service gets a few retries
+# rather than every request retried several times over
+RETRY_BUDGET_RATIO: Final[float] = 0.1
+RETRY_BUDGET_MINIMUM: Final[int] = 10
+
+
+class RateLimit(NamedTuple):
+    # Requests per second to start at; healthy responses raise it towards max_rate and 429s halve it
+    rate: float
+    burst: int = 10
+    min_rate: float = 0.2
+    max_rate: Optional[float] = None
+
+    @property
+    def ceiling(self) -> float:
+        return max(self.max_rate, self.rate) if self.max_rate is not None else self.rate * 4
+
+
+def retry_after_seconds(value: Optional[str], now: Optional[datetime] = None) -> Optional[float]:
+    # Retry-After is either a number of seconds or an HTTP date
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    now = now or datetime.now(timezone.utc)
+    return max(0.0, (retry_at - now).total_seconds())
+
+
+def backoff(attempt: int) -> float:
+    return random.uniform(0, min(RETRY_BACKOFF * 2 ** (attempt - 1), RETRY_MAX_BACKOFF))
+
+
+class HostLimiter:
+    # A token bucket for one host whose refill rate adapts to the responses: it grows by a fixed step after each
+    # healthy response and halves on a 429, and a Retry-After holds every request to the host until it passes.
+    # It also keeps the host's retry budget.
+    def __init__(self, host: str, limit: RateLimit) -> None:
+        self.host: Final[str] = host
+        self.limit: Final[RateLimit] = limit
+        self.__lock = threading.Lock()
+        self.__rate = limit.rate
+        self.__tokens = float(limit.burst)
+        self.__refilled_at = time.monotonic()
+        self.__paused_until = 0.0
+        self.__requests = 0
+        self.__retries = 0
+
+    @property
+    def rate(self) -> float:
+        with self.__lock:
+            return self.__rate
+
+    def acquire(self) -> None:
+        while True:
+            with self.__lock:
+                now = time.monotonic()
+                self.__tokens = min(self.limit.burst, self.__tokens + (now - self.__refilled_at) * self.__rate)
+                self.__refilled_at = now
+                if now < self.__paused_until:
+                    wait = self.__paused_until - now
+                elif self.__tokens >= 1:
+                    self.__tokens -= 1
+                    self.__requests += 1
+                    return
+                else:
+                    wait = (1 - self.__tokens) / self.__rate
+            time.sleep(wait)
+
+    def succeeded(self) -> None:
+        with self.__lock:
+            self.__rate = min(self.limit.ceiling, self.__rate + self.limit.rate / 20)
+
+    def throttled(self, retry_after: Optional[float]) -> None:
+        with self.__lock:
+            self.__rate = max(self.limit.min_rate, self.__rate / 2)
+            # Drop saved-up tokens so the burst does not hit the host again as soon as the pause ends
+            self.__tokens = 0.0
+            if retry_after is not None:
+                self.__paused_until = max(self.__paused_until, time.monotonic() + retry_after)
+        METRICS.increment("http_throttled", host=self.host)
+
+    def try_retry(self) -> bool:
+        with self.__lock:
+            if self.__retries >= RETRY_BUDGET_MINIMUM + self.__requests * RETRY_BUDGET_RATIO:
+                return False
+            self.__retries += 1
+            return True
+
+
+class RateLimiter:
+    # One HostLimiter per host, shared by every session that sends through it
+    def __init__(self, default: RateLimit) -> None:
+        self.__default: Final[RateLimit] = default
+        self.__limits: Final[Dict[str, RateLimit]] = {}
+        self.__hosts: Final[Dict[str, HostLimiter]] = {}
+        self.__lock = threading.Lock()
+
+    def configure(self, url: str, limit: RateLimit) -> None:
+        host = urlsplit(url).netloc
+        with self.__lock:
+            self.__limits[host] = limit
+            if host in self.__hosts and self.__hosts[host].limit != limit:
+                del self.__hosts[host]
+
+    def for_url(self, url: str) -> HostLimiter:
+        host = urlsplit(url).netloc
+        with self.__lock:
+            if host not in self.__hosts:
+                self.__hosts[host] = HostLimiter(host, self.__limits.get(host, self.__default))
+            return self.__hosts[host]
+
+
+RATE_LIMITER: Final[RateLimiter] = RateLimiter(RateLimit(rate=10.0))
+
+
+class ThrottledAdapter(HTTPAdapter):
+    # Sends every request through its host's limiter and retries 429s, and server or connection errors on
+    # idempotent requests, while the host's retry budget lasts
+    def __init__(self, service: str, limiter: RateLimiter = RATE_LIMITER,
+                 max_attempts: int = DEFAULT_MAX_ATTEMPTS, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.__service: Final[str] = service
+        self.__limiter: Final[RateLimiter] = limiter
+        self.__max_attempts: Final[int] = max_attempts
+
+    def send(self, request: PreparedRequest, **kwargs) -> Response:
+        host = self.__limiter.for_url(request.url)
+        idempotent = request.method in IDEMPOTENT_METHODS
+        attempt = 1
+        while True:
+            host.acquire()
+            try:
+                response = super().send(request, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if not idempotent or attempt >= self.__max_attempts or not host.try_retry():
+                    raise
+                delay = backoff(attempt)
+            else:
+                if response.status_code == THROTTLED_STATUS:
+                    retry_after = retry_after_seconds(response.headers.get("Retry-After"))
+                    if retry_after is not None and retry_after > MAX_RETRY_AFTER:
+                        return response
+                    host.throttled(retry_after)
+                    # The limiter holds the host until Retry-After passes, or paces it at the lowered rate
+                    delay = 0.0
+                elif response.status_code in RETRY_STATUSES and idempotent:
+                    delay = backoff(attempt)
+                else:
+                    if response.status_code < 500:
+                        host.succeeded()
+                    return response
+
+                if attempt >= self.__max_attempts or not host.try_retry():
+                    return response
+                # Release the connection before trying again
+                response.content
+                response.close()
+
+            METRICS.increment("http_retries", service=self.__service)
+            time.sleep(delay)
+            attempt += 1
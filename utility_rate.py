@@ -1,8 +1,19 @@
+import json
+import operator
+import os
+from bisect import bisect_right
 from collections import namedtuple
-from datetime import date
-from typing import Final, Union, List, Tuple
+from datetime import date, timedelta
+from functools import lru_cache
+from typing import Final, Union, List, Tuple, Sequence, Optional
+
+from metrics import METRICS
+from numeric import optional_numpy
 
 AssessedCharge = namedtuple("AssessedCharge", ["name", "description", "amount"])
+Range = namedtuple("Range", ["start", "end"])
+PeriodFactors = namedtuple("PeriodFactors", ["fixed", "rates"])
+RateSchedule = namedtuple("RateSchedule", ["effective_date", "charges"])
 
 
 class Charge:
@@ -16,6 +27,10 @@ class FixedCharge(Charge):
         super().__init__(name, "Flat Rate per Unit")
         self.__charge = charge
 
+    @property
+    def charge(self) -> float:
+        return self.__charge
+
     def calculate(self, parties: int) -> float:
         return self.__charge / parties
 
@@ -25,112 +40,209 @@ class UsageBasedCharge(Charge):
         super().__init__(name, "Usage Based")
         self.__rate = usage_rate
 
+    @property
+    def rate(self) -> float:
+        return self.__rate
+
     def calculate(self, usage: float) -> float:
         return usage * self.__rate
 
 
+# Index of the first day of each month within a leap year, so every month/day pair has a fixed day of year
+_MONTH_STARTS: Final[Tuple[int, ...]] = (0, 31, 60, 91, 121, 152, 182, 213, 244, 274, 305, 335)
+
+
+def day_of_year(day: date) -> int:
+    return _MONTH_STARTS[day.month - 1] + day.day - 1
+
+
 class SeasonalUsageBasedCharge(Charge):
     def __init__(self, name: str, usage_rate: List[Tuple[Tuple[str, str], float]]):
         super().__init__(name, "Usage Based with Seasonal Rates")
-        self.__rate = usage_rate
+        self.__rate = [(tuple(tuple(int(i) for i in boundary.split("/")) for boundary in rate_period), season_rate)
+                       for rate_period, season_rate in usage_rate]
+        # The season covering each day of a leap year, or None outside every season
+        season_by_day: List[Optional[int]] = [None] * 366
+        for season, ((rp_start, rp_end), _) in enumerate(self.__rate):
+            for day in range(day_of_year(date(2000, *rp_start)), day_of_year(date(2000, *rp_end)) + 1):
+                season_by_day[day] = season
+        self.__season_by_day: Final[Tuple[Optional[int], ...]] = tuple(season_by_day)
+
+    def rate_on(self, day: date) -> float:
+        season = self.__season_by_day[day_of_year(day)]
+        return self.__rate[season][1] if season is not None else 0
+
+    def daily_rates(self, start: date, days: int) -> List[float]:
+        return [self.rate_on(start + timedelta(days=n)) for n in range(days)]
+
+    def effective_rate(self, date_range: Tuple[date, date]) -> float:
+        # Assumes usage was spread evenly over every day from the start of the range up to the end, the same
+        # days period_daily_rates bills one by one
+        usage_range = Range(*date_range)
+        period_days = max(1, (usage_range.end - usage_range.start).days)
+        days_in_season: List[int] = [0] * len(self.__rate)
+        for n in range(period_days):
+            season = self.__season_by_day[day_of_year(usage_range.start + timedelta(days=n))]
+            if season is not None:
+                days_in_season[season] += 1
+
+        rate: float = 0
+        for ((_, season_rate), days) in zip(self.__rate, days_in_season):
+            rate += season_rate * days / period_days
+
+        return rate
 
     def calculate(self, usage: float, date_range: Tuple[date, date]) -> float:
-        Range = namedtuple('Range', ['start', 'end'])
+        return usage * self.effective_rate(date_range)
 
-        charge: float = 0
 
-        for rate_period, season_rate in self.__rate:
-            for y in set([d.year for d in date_range]):
-                # When the year rolls over, we need to check both years to ensure there are no gaps.
-                # A better date range algorithm would not have these same issues, but alas, this is the one we have.
-                rp_start = [int(i) for i in rate_period[0].split("/")]
-                rp_end = [int(i) for i in rate_period[1].split("/")]
+charge_type = Union[FixedCharge, UsageBasedCharge, SeasonalUsageBasedCharge]
 
-                rate_range = Range(start=date(y, *rp_start), end=date(y, *rp_end))
+RATES_FILE: Final[str] = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rates.json")
+RATES_FILE_VERSION: Final[int] = 1
 
-                usage_range = Range(*date_range)
-                latest_start = max(usage_range.start, rate_range.start)
-                earliest_end = min(usage_range.end, rate_range.end)
-                delta = (earliest_end - latest_start).days + 1
-                overlap = max(0, delta)
 
-                ratio = overlap / ((usage_range.end - usage_range.start).days + 1)
-                charge += usage * season_rate * ratio
+def charge_from_dict(entry: dict) -> charge_type:
+    if entry["type"] == "fixed":
+        return FixedCharge(entry["name"], entry["amount"])
+    if entry["type"] == "usage":
+        return UsageBasedCharge(entry["name"], entry["rate"])
+    if entry["type"] == "seasonal":
+        return SeasonalUsageBasedCharge(entry["name"], [((season["start"], season["end"]), season["rate"])
+                                                        for season in entry["seasons"]])
+    raise ValueError(f"Unexpected charge type: {entry['type']}")
 
-        return charge
 
+class RateTable:
+    # Every rate schedule in the rates file, ordered by the day it takes effect. A metering period is billed
+    # with the schedule in effect on its first day, found by bisecting the effective dates, so re-billing an
+    # old period uses the prices of the time.
+    def __init__(self, schedules: Sequence[RateSchedule]) -> None:
+        self.schedules: Final[Tuple[RateSchedule, ...]] = tuple(sorted(schedules, key=lambda s: s.effective_date))
+        self.__effective_dates: Final[List[date]] = [schedule.effective_date for schedule in self.schedules]
 
-charge_type = Union[FixedCharge, UsageBasedCharge, SeasonalUsageBasedCharge]
+    def schedule_for(self, metering_period: Tuple[date, date]) -> RateSchedule:
+        index = bisect_right(self.__effective_dates, metering_period[0]) - 1
+        if index < 0:
+            raise ValueError(f"No rate schedule is in effect on {metering_period[0].strftime('%m/%d/%Y')}")
+        return self.schedules[index]
 
-# Commercial Rate / Inside Seattle, 1x 2" and 1x 1" meters
-# Source: https://www.seattle.gov/utilities/your-services/accounts-and-payments/rates/water/commercial-water-rates
-WATER_BASE_CHARGE: Final[charge_type] = FixedCharge("Water Base Charge", 44.35 + 26.00)
-# Commercial Rate / Inside Seattle
-# Source: https://www.seattle.gov/utilities/your-services/accounts-and-payments/rates/water/commercial-water-rates
-WATER_USAGE_CHARGE: Final[charge_type] = SeasonalUsageBasedCharge("Water Usage", [
-    (("1/1", "5/15"), 6.06),
-    (("5/16", "9/15"), 7.70),
-    (("9/16", "12/31"), 6.06),
-])
-
-# Same rate all year
-# Source: https://www.seattle.gov/utilities/your-services/accounts-and-payments/rates/sewer
-SEWER_CHARGE: Final[charge_type] = UsageBasedCharge("Sewer Usage", 20.18)
-
-# Residential Account Fee
-# Source: https://www.seattle.gov/utilities/your-services/accounts-and-payments/rates/collection-and-disposal/garbage-rates/residential-dumpster-rates
-DUMPSTER_BASE_CHARGE: Final[charge_type] = FixedCharge("Dumpster Base Fee", 51.15)
-
-# Residential Garbage Dumpster - 0.75 yd
-# Source: https://www.seattle.gov/utilities/your-services/accounts-and-payments/rates/collection-and-disposal/garbage-rates/residential-dumpster-rates
-GARBAGE_CHARGE: Final[charge_type] = FixedCharge("Garbage", 261.42)
-
-# Multi Family Food & Yard Rate - 96 Gallon
-# Source: https://www.seattle.gov/utilities/your-services/accounts-and-payments/rates/collection-and-disposal/food-and-yard-rates/multi-family-rates
-YARD_WASTE_CHARGE: Final[charge_type] = FixedCharge("Yard Waste", 14.75)
-
-# Recycling Rate - No Cost
-# Source: https://www.seattle.gov/utilities/your-services/accounts-and-payments/rates/collection-and-disposal/recycling-rates
-RECYCLE_CHARGE: Final[charge_type] = FixedCharge("Recycling", 0)
-
-# Next Century Submetering Rate
-SUB_METERING_CHARGE: Final[charge_type] = FixedCharge("Sub-metering", 65)
-
-CHARGES: Final[List[charge_type]] = [
-    WATER_BASE_CHARGE,
-    WATER_USAGE_CHARGE,
-    SEWER_CHARGE,
-    DUMPSTER_BASE_CHARGE,
-    GARBAGE_CHARGE,
-    YARD_WASTE_CHARGE,
-    RECYCLE_CHARGE,
-    SUB_METERING_CHARGE
-]
+    def charges_for(self, metering_period: Tuple[date, date]) -> Tuple[charge_type, ...]:
+        return self.schedule_for(metering_period).charges
 
+    @staticmethod
+    def load(path: str) -> 'RateTable':
+        with open(path) as f:
+            rates = json.load(f)
+        if rates.get("version") != RATES_FILE_VERSION:
+            raise ValueError(f"Unsupported rates file version {rates.get('version')} in {path}")
 
-def calculate_bill(number_of_units: int, water_usage: float, metering_period: Tuple[date, date]) \
-        -> List[AssessedCharge]:
-    calculated_charges: List[AssessedCharge] = list()
+        return RateTable([RateSchedule(date.fromisoformat(schedule["effectiveDate"]),
+                                       tuple(charge_from_dict(charge) for charge in schedule["charges"]))
+                          for schedule in rates["schedules"]])
 
-    for charge in CHARGES:
+
+@lru_cache(maxsize=None)
+def rate_table(path: Optional[str] = None) -> RateTable:
+    return RateTable.load(path or os.environ.get("RATES_FILE") or RATES_FILE)
+
+
+@lru_cache(maxsize=128)
+def period_factors(number_of_units: int, metering_period: Tuple[date, date],
+                   charges: Tuple[charge_type, ...]) -> PeriodFactors:
+    # Every charge is linear in usage, so a unit's bill is fixed[i] + usage * rates[i] for each charge i
+    fixed: List[float] = []
+    rates: List[float] = []
+
+    for charge in charges:
         if isinstance(charge, FixedCharge):
-            calculated_charges.append(
-                AssessedCharge(charge.name, charge.description, charge.calculate(number_of_units)))
+            fixed.append(charge.calculate(number_of_units))
+            rates.append(0)
         elif isinstance(charge, UsageBasedCharge):
-            calculated_charges.append(
-                AssessedCharge(
-                    charge.name,
-                    f"{charge.description} - {ccf_to_gallons(water_usage)} Gallons",
-                    charge.calculate(water_usage)))
+            fixed.append(0)
+            rates.append(charge.rate)
         elif isinstance(charge, SeasonalUsageBasedCharge):
-            calculated_charges.append(
-                AssessedCharge(charge.name,
-                               f"{charge.description} - {ccf_to_gallons(water_usage)} Gallons",
-                               charge.calculate(water_usage, metering_period)))
+            fixed.append(0)
+            rates.append(charge.effective_rate(metering_period))
         else:
             raise Exception("Unexpected Charge Class")
 
-    return calculated_charges
+    return PeriodFactors(tuple(fixed), tuple(rates))
+
+
+def describe_charge(charge: charge_type, water_usage: float) -> str:
+    if isinstance(charge, FixedCharge):
+        return charge.description
+
+    return f"{charge.description} - {ccf_to_gallons(water_usage)} Gallons"
+
+
+class BillMatrix:
+    def __init__(self, charges: Sequence[charge_type], water_usage: Sequence[float], amounts) -> None:
+        self.charges: Final[Sequence[charge_type]] = charges
+        self.water_usage: Final[Sequence[float]] = water_usage
+        # units x charges, either a NumPy array or a list of rows
+        self.amounts: Final = amounts
+
+    def __len__(self) -> int:
+        return len(self.water_usage)
+
+    def assessed_charges(self, unit_index: int) -> List[AssessedCharge]:
+        water_usage = self.water_usage[unit_index]
+        return [AssessedCharge(charge.name, describe_charge(charge, water_usage), float(amount))
+                for charge, amount in zip(self.charges, self.amounts[unit_index])]
+
+
+@lru_cache(maxsize=128)
+def period_daily_rates(metering_period: Tuple[date, date],
+                       charges: Tuple[charge_type, ...]) -> Tuple[Optional[Tuple[float, ...]], ...]:
+    # For each seasonal charge, its rate on every day from the start of the period up to the end
+    start, end = metering_period
+    return tuple(tuple(charge.daily_rates(start, (end - start).days))
+                 if isinstance(charge, SeasonalUsageBasedCharge) else None for charge in charges)
+
+
+def calculate_bills(water_usage: Sequence[float], metering_period: Tuple[date, date],
+                    daily_usage: Optional[Sequence[Sequence[float]]] = None,
+                    number_of_units: Optional[int] = None) -> BillMatrix:
+    # daily_usage[u][n], when known, is unit u's usage on day n of the period. Seasonal charges then bill
+    # each day at its own season instead of spreading the period's usage evenly. Fixed charges are split
+    # across number_of_units, which defaults to the units billed here.
+    with METRICS.span("phase", phase="bill_calculation"):
+        charges = rate_table().charges_for(metering_period)
+        factors = period_factors(len(water_usage) if number_of_units is None else number_of_units,
+                                 metering_period, charges)
+        daily_rates = period_daily_rates(metering_period, charges) if daily_usage is not None else ()
+        numpy = optional_numpy()
+
+        if numpy is not None:
+            usage = numpy.asarray(water_usage, dtype=float)
+            amounts = usage[:, None] * numpy.asarray(factors.rates) + numpy.asarray(factors.fixed)
+            if daily_usage is not None and len(water_usage):
+                daily = numpy.asarray(daily_usage, dtype=float)
+                for i, rates in enumerate(daily_rates):
+                    if rates is not None:
+                        amounts[:, i] = factors.fixed[i] + daily @ numpy.asarray(rates)
+        else:
+            amounts = [[fixed + usage * rate for fixed, rate in zip(factors.fixed, factors.rates)]
+                       for usage in water_usage]
+            if daily_usage is not None:
+                for row, unit_daily_usage in zip(amounts, daily_usage):
+                    for i, rates in enumerate(daily_rates):
+                        if rates is not None:
+                            row[i] = factors.fixed[i] + sum(map(operator.mul, unit_daily_usage, rates))
+
+    METRICS.increment("bills_calculated", len(water_usage))
+    return BillMatrix(charges, water_usage, amounts)
+
+
+def calculate_bill(number_of_units: int, water_usage: float, metering_period: Tuple[date, date]) \
+        -> List[AssessedCharge]:
+    charges = rate_table().charges_for(metering_period)
+    factors = period_factors(number_of_units, metering_period, charges)
+
+    return [AssessedCharge(charge.name, describe_charge(charge, water_usage), fixed + water_usage * rate)
+            for charge, fixed, rate in zip(charges, factors.fixed, factors.rates)]
 
 
 def gallons_to_ccf(gallons: int) -> float:
@@ -142,6 +254,5 @@ def ccf_to_gallons(ccf: float) -> int:
 
 
 if __name__ == '__main__':
-    bill = calculate_bill(8, gallons_to_ccf(820), (date(2023, 1, 1), date(2023, 2, 1)))
-    print(bill[1])
-    print(f"=== Total Charge ===  ${bill[0]:,.2f}")
+    import cli
+    cli.main(["preview"])